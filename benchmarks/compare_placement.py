@@ -0,0 +1,110 @@
+"""Compare the multinode placement engines on lookup speed, memory, balance and keys remapped on membership changes."""
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from memory_backend import MemoryBackend
+from run_benchmarks import first_port, load_script
+
+engines = ["ketama", "jump", "rendezvous", "maglev"]
+
+
+# Function to build an engine through the script, measuring the memory its routing structures hold
+def build_placement(module, engine, node_keys):
+    module.placement_engine = engine
+    tracemalloc.start()
+    module.hash_ring = module.create_placement(node_keys)
+    module.ring_nodes()  # Ketama's sorted arrays are part of its routing state
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return memory
+
+
+# Function to assign every key to a node name with the script's batch router
+def assign(module, hashes):
+    nodes = module.ring_nodes()
+    return np.array(nodes)[module.route_hashes(hashes)]
+
+
+# Function to benchmark one engine on one cluster size
+def compare_engine(module, engine, node_count, keys, hashes, single_lookups):
+    node_keys = [f"localhost:{first_port + i}" for i in range(node_count)]
+    metrics = {"memory_bytes": build_placement(module, engine, node_keys)}
+
+    start_time = time.perf_counter()
+    owners = assign(module, hashes)
+    metrics["batch_lookups_per_sec"] = len(keys) / (time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    for key in keys[:single_lookups]:
+        module.hash_ring.get_node(key)
+    metrics["single_lookups_per_sec"] = single_lookups / (time.perf_counter() - start_time)
+
+    counts = np.array([np.count_nonzero(owners == node) for node in node_keys])
+    metrics["load_relative_stddev"] = float(counts.std() / counts.mean())
+    metrics["load_max_over_mean"] = float(counts.max() / counts.mean())
+
+    # Ideal movement is 1/(n+1) of the keys when a node joins and 1/n when one leaves
+    module.hash_ring.add_node(f"localhost:{first_port + node_count}")
+    metrics["remapped_on_add"] = float(np.mean(assign(module, hashes) != owners))
+    build_placement(module, engine, node_keys)
+    module.hash_ring.remove_node(node_keys[len(node_keys) // 2])
+    metrics["remapped_on_remove"] = float(np.mean(assign(module, hashes) != owners))
+    metrics["ideal_remapped_on_add"] = 1 / (node_count + 1)
+    metrics["ideal_remapped_on_remove"] = 1 / node_count
+    return metrics
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--keys", type=int, default=200000, help="keys routed per engine")
+    parser.add_argument("--single-lookups", type=int, default=20000, help="keys routed one at a time")
+    parser.add_argument("--nodes", type=lambda value: [int(v) for v in value.split(",")], default=[3, 5, 10])
+    parser.add_argument("--engines", type=lambda value: value.split(","), default=engines)
+    parser.add_argument("--balance-target", type=float, default=0.05,
+                        help="largest acceptable relative standard deviation of keys per node")
+    parser.add_argument("--output", help="write JSON results to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    module = load_script("multinode", MemoryBackend(), 1)
+    keys = [str(i) for i in range(options.keys)]
+    hashes = module.hash_many(keys)
+
+    records = []
+    for node_count in options.nodes:
+        for engine in options.engines:
+            metrics = compare_engine(module, engine, node_count, keys, hashes, min(options.single_lookups, len(keys)))
+            records.append({"engine": engine, "nodes": node_count, "metrics": metrics})
+            print(f"{engine:>10} nodes={node_count:<3} "
+                  f"batch={metrics['batch_lookups_per_sec']:>12,.0f}/s single={metrics['single_lookups_per_sec']:>10,.0f}/s "
+                  f"memory={metrics['memory_bytes']:>9,}B stddev={metrics['load_relative_stddev']:.3f} "
+                  f"max/mean={metrics['load_max_over_mean']:.3f} "
+                  f"add={metrics['remapped_on_add']:.3f} (ideal {metrics['ideal_remapped_on_add']:.3f}) "
+                  f"remove={metrics['remapped_on_remove']:.3f} (ideal {metrics['ideal_remapped_on_remove']:.3f})")
+
+    # Recommend the fastest engine whose balance meets the target on every cluster size
+    balanced = [engine for engine in options.engines
+                if all(record["metrics"]["load_relative_stddev"] <= options.balance_target
+                       for record in records if record["engine"] == engine)]
+    speed = {engine: min(record["metrics"]["batch_lookups_per_sec"] for record in records if record["engine"] == engine)
+             for engine in balanced}
+    recommended = max(speed, key=speed.get) if speed else None
+    print(f"Fastest engine within a {options.balance_target:.0%} balance target: {recommended or 'none'}")
+
+    if options.output:
+        with open(options.output, "w") as output:
+            json.dump({"keys": options.keys, "balance_target": options.balance_target, "recommended": recommended,
+                       "results": records}, output, indent=2)
+        print(f"Results written to {options.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,427 @@
+"""In-memory storage backend with the subset of the Motor API the scripts use, plus simulated latency."""
+import asyncio
+import copy
+import random
+from bisect import bisect_left, bisect_right
+from types import SimpleNamespace
+
+import bson
+from bson import ObjectId
+from bson.raw_bson import RawBSONDocument
+from pymongo import DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+
+# Backend holding one in-memory server per address, so reconnecting to a node finds its data again
+class MemoryBackend:
+    def __init__(self, latency=0.0, jitter=0.0, per_document_latency=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.per_document_latency = per_document_latency
+        self.random = random.Random(seed)
+        self.servers = {}
+
+    # Drop-in replacement for the scripts' create_client(host, port)
+    def connect(self, host, port):
+        address = f"{host}:{port}"
+        if address not in self.servers:
+            self.servers[address] = MemoryClient(self)
+        return self.servers[address]
+
+    # Simulate one network round trip, plus the cost of moving documents over it
+    async def round_trip(self, documents=0):
+        delay = self.latency + self.per_document_latency * documents
+        if delay:
+            await asyncio.sleep(delay * (1 + self.jitter * self.random.random()))
+        else:
+            await asyncio.sleep(0)
+
+
+class MemoryClient:
+    def __init__(self, backend):
+        self.backend = backend
+        self.databases = {}
+
+    def __getitem__(self, name):
+        if name not in self.databases:
+            self.databases[name] = MemoryDatabase(self, name)
+        return self.databases[name]
+
+    def close(self):
+        pass
+
+
+class MemoryDatabase:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = MemoryCollection(self, name)
+        return self.collections[name]
+
+    # Only "ping" is supported, which is what health checks send
+    async def command(self, name):
+        await self.client.backend.round_trip()
+        if name != "ping":
+            raise NotImplementedError(f"Command '{name}' is not supported by the in-memory backend")
+        return {"ok": 1.0}
+
+
+# Function to compare a field against a bound, treating missing fields and mismatched types as no match
+def _compare(value, bound, operator):
+    if value is None:
+        return False
+    try:
+        return operator(value, bound)
+    except TypeError:
+        return False
+
+
+_operators = {
+    "$gt": lambda value, bound: _compare(value, bound, lambda a, b: a > b),
+    "$gte": lambda value, bound: _compare(value, bound, lambda a, b: a >= b),
+    "$lt": lambda value, bound: _compare(value, bound, lambda a, b: a < b),
+    "$lte": lambda value, bound: _compare(value, bound, lambda a, b: a <= b),
+    "$eq": lambda value, bound: value == bound,
+    "$ne": lambda value, bound: value != bound,
+    "$in": lambda value, bound: value in bound,
+    "$nin": lambda value, bound: value not in bound,
+}
+
+# Operators a sorted index can answer with a bisect
+range_operators = {"$gt", "$gte", "$lt", "$lte"}
+
+
+# Function to turn $in/$nin lists into sets once per query instead of once per document
+def prepare(query):
+    prepared = {}
+    for field, condition in query.items():
+        if field in ("$or", "$and"):
+            prepared[field] = [prepare(clause) for clause in condition]
+        elif isinstance(condition, dict):
+            prepared[field] = {operator: set(bound) if operator in ("$in", "$nin") else bound
+                               for operator, bound in condition.items()}
+        else:
+            prepared[field] = condition
+    return prepared
+
+
+# Function to check a document against a query filter ($and/$or, equality and the comparison operators)
+def matches(document, query):
+    for field, condition in query.items():
+        if field == "$or":
+            if not any(matches(document, clause) for clause in condition):
+                return False
+        elif field == "$and":
+            if not all(matches(document, clause) for clause in condition):
+                return False
+        elif isinstance(condition, dict) and condition and next(iter(condition)).startswith("$"):
+            for operator, bound in condition.items():
+                if operator == "$exists":
+                    if (field in document) != bool(bound):
+                        return False
+                elif not _operators[operator](document.get(field), bound):
+                    return False
+        elif document.get(field) != condition:
+            return False
+    return True
+
+
+# Function to apply a projection such as {"_id": 1} or {"value": 0}
+def project(document, projection):
+    if not projection:
+        return dict(document)
+    included = {field for field, flag in projection.items() if flag}
+    if included:
+        projected = {field: document[field] for field in included if field in document}
+        if projection.get("_id", 1) and "_id" in document:
+            projected["_id"] = document["_id"]
+        return projected
+    return {field: value for field, value in document.items() if projection.get(field, 1)}
+
+
+# Function to apply $set/$unset updates, or replace the document when no operators are given
+def apply_update(document, update):
+    if not any(field.startswith("$") for field in update):
+        return dict(update, _id=document["_id"])
+    updated = dict(document)
+    for field, value in update.get("$set", {}).items():
+        updated[field] = value
+    for field in update.get("$unset", {}):
+        updated.pop(field, None)
+    return updated
+
+
+# Function to copy a document for storage, giving it an _id; dicts pay the driver's encode, raw BSON passes through
+def stored_copy(document):
+    if isinstance(document, RawBSONDocument):
+        return bson.decode(document.raw)
+    if "_id" not in document:
+        document["_id"] = ObjectId()
+    return bson.decode(bson.encode(document))
+
+
+class MemoryCollection:
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.full_name = f"{database.name}.{name}"
+        self.documents = {}
+        self.indexes = {}  # field -> (sorted values, _ids) or None when it needs rebuilding
+        self.codec_options = None
+
+    @property
+    def backend(self):
+        return self.database.client.backend
+
+    # A view of the same documents that returns them as configured, e.g. as RawBSONDocument
+    def with_options(self, codec_options=None, **kwargs):
+        view = copy.copy(self)
+        view.codec_options = codec_options
+        return view
+
+    # Function to hand a stored document to the client as a server reply: BSON, decoded unless a raw codec is set
+    def _output(self, document, projection):
+        document = project(document, projection)
+        if "_id" in document:
+            document = {"_id": document["_id"], **document}  # Servers keep _id as the first field
+        raw = bson.encode(document)
+        if self.codec_options is None or self.codec_options.document_class is not RawBSONDocument:
+            return bson.decode(raw)
+        return RawBSONDocument(raw, self.codec_options)
+
+    # Function to get the documents a filter could match, using _id lookups or a range index when possible
+    def _candidates(self, query):
+        if "_id" in query:
+            condition = query["_id"]
+            if not isinstance(condition, dict):
+                keys = [condition]
+            elif set(condition) == {"$in"}:
+                keys = condition["$in"]
+            else:
+                keys = None
+            if keys is not None:
+                return [self.documents[key] for key in dict.fromkeys(keys) if key in self.documents]
+
+        clauses = query["$or"] if set(query) == {"$or"} else [query]
+        fields = {field for clause in clauses for field in clause}
+        if len(fields) == 1:
+            field = next(iter(fields))
+            # Only range bounds can use the index; it leaves out documents missing the field, which $exists wants
+            if field in self.indexes and all(isinstance(clause[field], dict) and set(clause[field]) <= range_operators
+                                             for clause in clauses):
+                values, keys = self._index(field)
+                candidates = {}
+                for clause in clauses:
+                    low = clause[field].get("$gte", clause[field].get("$gt"))
+                    high = clause[field].get("$lte", clause[field].get("$lt"))
+                    start = bisect_left(values, low) if low is not None else 0
+                    end = bisect_right(values, high) if high is not None else len(values)
+                    for key in keys[start:end]:
+                        candidates[key] = self.documents[key]
+                return list(candidates.values())
+        return list(self.documents.values())
+
+    # Function to build (lazily) a sorted index of one field as parallel value and _id lists
+    def _index(self, field):
+        if self.indexes[field] is None:
+            entries = sorted(((document[field], key) for key, document in self.documents.items()
+                              if document.get(field) is not None), key=lambda entry: entry[0])
+            self.indexes[field] = ([value for value, _ in entries], [key for _, key in entries])
+        return self.indexes[field]
+
+    def _changed(self):
+        for field in self.indexes:
+            self.indexes[field] = None
+
+    def _matching(self, query):
+        query = prepare(query or {})
+        return [document for document in self._candidates(query) if matches(document, query)]
+
+    async def create_index(self, keys, **kwargs):
+        field = keys if isinstance(keys, str) else keys[0][0]
+        self.indexes.setdefault(field, None)
+        await self.backend.round_trip()
+        return f"{field}_1"
+
+    async def insert_one(self, document):
+        await self.backend.round_trip(1)
+        document = stored_copy(document)
+        if document["_id"] in self.documents:
+            raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.full_name}", 11000)
+        self.documents[document["_id"]] = document
+        self._changed()
+        return SimpleNamespace(inserted_id=document["_id"], acknowledged=True)
+
+    async def insert_many(self, documents, ordered=True):
+        documents = list(documents)
+        await self.backend.round_trip(len(documents))
+        write_errors = []
+        inserted = 0
+        for index, document in enumerate(documents):
+            document = stored_copy(document)
+            if document["_id"] in self.documents:
+                write_errors.append({"index": index, "code": 11000, "errmsg": "E11000 duplicate key error",
+                                     "op": document})
+                if ordered:
+                    break
+                continue
+            self.documents[document["_id"]] = document
+            inserted += 1
+        if inserted:
+            self._changed()
+        if write_errors:
+            raise BulkWriteError({"writeErrors": write_errors, "writeConcernErrors": [], "nInserted": inserted,
+                                  "nUpserted": 0, "nMatched": 0, "nModified": 0, "nRemoved": 0, "upserted": []})
+        return SimpleNamespace(inserted_ids=[document["_id"] for document in documents], acknowledged=True)
+
+    def find(self, filter=None, projection=None):
+        return MemoryCursor(self, filter or {}, projection)
+
+    async def find_one(self, filter=None, projection=None):
+        await self.backend.round_trip(1)
+        for document in self._matching(filter):
+            return self._output(document, projection)
+        return None
+
+    async def count_documents(self, filter):
+        await self.backend.round_trip()
+        return len(self._matching(filter))
+
+    async def estimated_document_count(self):
+        await self.backend.round_trip()
+        return len(self.documents)
+
+    async def delete_one(self, filter):
+        await self.backend.round_trip()
+        return SimpleNamespace(deleted_count=self._delete(filter, many=False), acknowledged=True)
+
+    async def delete_many(self, filter):
+        await self.backend.round_trip()
+        return SimpleNamespace(deleted_count=self._delete(filter, many=True), acknowledged=True)
+
+    def _delete(self, filter, many):
+        matching = self._matching(filter)
+        if not many:
+            matching = matching[:1]
+        for document in matching:
+            del self.documents[document["_id"]]
+        if matching:
+            self._changed()
+        return len(matching)
+
+    async def replace_one(self, filter, replacement, upsert=False):
+        await self.backend.round_trip(1)
+        return self._update(filter, replacement, upsert, many=False)
+
+    async def update_one(self, filter, update, upsert=False):
+        await self.backend.round_trip(1)
+        return self._update(filter, update, upsert, many=False)
+
+    async def update_many(self, filter, update, upsert=False):
+        await self.backend.round_trip()
+        return self._update(filter, update, upsert, many=True)
+
+    def _update(self, filter, update, upsert, many):
+        matching = self._matching(filter)
+        if not many:
+            matching = matching[:1]
+        for document in matching:
+            self.documents[document["_id"]] = apply_update(document, update)
+        upserted_id = None
+        if not matching and upsert:
+            equality = {field: value for field, value in filter.items()
+                        if not field.startswith("$") and not isinstance(value, dict)}
+            document = apply_update(dict(equality, _id=filter.get("_id", ObjectId())), update)
+            self.documents[document["_id"]] = document
+            upserted_id = document["_id"]
+        if matching or upserted_id is not None:
+            self._changed()
+        return SimpleNamespace(matched_count=len(matching), modified_count=len(matching), upserted_id=upserted_id,
+                               acknowledged=True)
+
+    async def bulk_write(self, requests, ordered=True):
+        requests = list(requests)
+        await self.backend.round_trip(len(requests))
+        counts = {"inserted": 0, "matched": 0, "upserted": 0, "deleted": 0}
+        for request in requests:
+            if isinstance(request, InsertOne):
+                document = stored_copy(request._doc)
+                self.documents[document["_id"]] = document
+                counts["inserted"] += 1
+            elif isinstance(request, (ReplaceOne, UpdateOne, UpdateMany)):
+                result = self._update(request._filter, request._doc, request._upsert,
+                                      many=isinstance(request, UpdateMany))
+                counts["matched"] += result.matched_count
+                counts["upserted"] += result.upserted_id is not None
+            elif isinstance(request, (DeleteOne, DeleteMany)):
+                counts["deleted"] += self._delete(request._filter, many=isinstance(request, DeleteMany))
+        self._changed()
+        return SimpleNamespace(inserted_count=counts["inserted"], matched_count=counts["matched"],
+                               modified_count=counts["matched"], upserted_count=counts["upserted"],
+                               deleted_count=counts["deleted"], acknowledged=True)
+
+
+# Cursor over a snapshot of the matching documents, fetched from the backend in batches
+class MemoryCursor:
+    def __init__(self, collection, filter, projection):
+        self.collection = collection
+        self.filter = filter
+        self.projection = projection
+        self.sort_keys = []
+        self.batch = 1000
+        self.skip_count = 0
+        self.limit_count = 0
+        self.results = None
+        self.position = 0
+
+    def sort(self, key, direction=1):
+        self.sort_keys = [(key, direction)] if isinstance(key, str) else list(key)
+        return self
+
+    def batch_size(self, batch_size):
+        self.batch = max(1, batch_size)
+        return self
+
+    def skip(self, skip):
+        self.skip_count = skip
+        return self
+
+    def limit(self, limit):
+        self.limit_count = limit
+        return self
+
+    def _snapshot(self):
+        documents = self.collection._matching(self.filter)
+        for field, direction in reversed(self.sort_keys):
+            documents.sort(key=lambda document: (document.get(field) is not None, document.get(field)),
+                           reverse=direction < 0)
+        documents = documents[self.skip_count:]
+        if self.limit_count:
+            documents = documents[:self.limit_count]
+        return [self.collection._output(document, self.projection) for document in documents]
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.results is None:
+            self.results = self._snapshot()
+        if self.position >= len(self.results):
+            raise StopAsyncIteration
+        if self.position % self.batch == 0:
+            await self.collection.backend.round_trip(min(self.batch, len(self.results) - self.position))
+        document = self.results[self.position]
+        self.position += 1
+        return document
+
+    async def to_list(self, length=None):
+        documents = []
+        async for document in self:
+            documents.append(document)
+            if length and len(documents) >= length:
+                break
+        return documents
@@ -0,0 +1,278 @@
+"""End-to-end benchmarks for the ring scripts, run against the in-memory backend instead of MongoDB."""
+import argparse
+import asyncio
+import contextlib
+import importlib.util
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+from memory_backend import MemoryBackend
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+scripts = {
+    "single-node": os.path.join(repository, "single-node", "insert_and_find_documents.py"),
+    "multinode": os.path.join(repository, "multinode", "hash_ring_mongodb_insert_and_find.py"),
+    "multinode-with-backup": os.path.join(repository, "multinode-with-backup", "ring_with_backup.py"),
+}
+first_port = 27019
+
+
+# Function to load a fresh copy of a script with its storage backend swapped for the in-memory one
+def load_script(name, backend, node_count=None):
+    # Scripts import their sibling modules, as they do when run from their own folder
+    if os.path.dirname(scripts[name]) not in sys.path:
+        sys.path.insert(0, os.path.dirname(scripts[name]))
+    spec = importlib.util.spec_from_file_location(name.replace("-", "_"), scripts[name])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module  # Lets producer processes unpickle the script's functions
+    spec.loader.exec_module(module)
+
+    if name == "single-node":
+        module.client.close()
+        module.create_client = lambda uri: backend.connect(*uri.split("//")[1].strip("/").split(":"))
+        module.client = module.create_client(module.mongo_uri)
+        module.db = module.client['mydatabase']
+        module.collection = module.db['mycollection']
+        return module
+
+    for client in module.mongo_clients.values():
+        client.close()
+    module.create_client = backend.connect
+    module.mongodb_nodes = [{"host": "localhost", "port": first_port + i} for i in range(node_count)]
+    module.hash_ring = module.HashRing(nodes=[f"{node['host']}:{node['port']}" for node in module.mongodb_nodes])
+    module.mongo_clients = {
+        f"{node['host']}:{node['port']}": backend.connect(node["host"], node["port"]) for node in module.mongodb_nodes
+    }
+    if hasattr(module, "client_manager"):
+        module.client_manager.clients = dict(module.mongo_clients)
+    if hasattr(module, "hint_log_path"):
+        module.hint_log_path = os.path.join(tempfile.mkdtemp(), "hints.log")
+    if hasattr(module, "ring_state_path"):
+        module.ring_state_path = os.path.join(tempfile.mkdtemp(), "ring.snapshot")
+        module.ring_epoch = 0
+    return module
+
+
+# Context manager silencing the scripts' progress prints
+@contextlib.contextmanager
+def silenced():
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+# Async function to run a coroutine silenced
+async def quietly(coroutine):
+    with silenced():
+        return await coroutine
+
+
+# Async function to time a coroutine, returning (result, seconds)
+async def timed(coroutine):
+    start_time = time.perf_counter()
+    result = await quietly(coroutine)
+    return result, time.perf_counter() - start_time
+
+
+# Function to get a percentile from a sorted list of samples
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(fraction * (len(samples) - 1))))]
+
+
+# Async function to measure single-key lookup latency and multi-get throughput on sampled keys
+async def measure_lookups(module, keys, multi_get_size=100):
+    module_cache = getattr(module, "document_cache", None)
+    if module_cache is not None:
+        module_cache.clear()
+    latencies = []
+    for key in keys:
+        _, seconds = await timed(module.find_document(key))
+        latencies.append(seconds * 1000)
+    metrics = {"lookup_p50_ms": percentile(latencies, 0.5), "lookup_p99_ms": percentile(latencies, 0.99)}
+
+    if hasattr(module, "find_documents"):
+        module_cache.clear()
+        start_time = time.perf_counter()
+        for batch_start in range(0, len(keys), multi_get_size):
+            await quietly(module.find_documents(keys[batch_start:batch_start + multi_get_size]))
+        metrics["multi_get_keys_per_sec"] = len(keys) / (time.perf_counter() - start_time)
+    return metrics
+
+
+# Async function to count documents on every node
+async def count_documents(module):
+    counts = {}
+    for node, client in module.mongo_clients.items():
+        counts[node] = await client['mydatabase']['mycollection'].count_documents({})
+    return counts
+
+
+# Benchmark: single node ingest and lookups
+async def bench_single_node(options, batch_size):
+    backend = options.backend()
+    module = load_script("single-node", backend)
+    _, seconds = await timed(module.insert_documents(options.docs + 1, batch_size))
+    keys = random.Random(options.seed).sample(range(1, options.docs + 1), min(options.lookups, options.docs))
+    metrics = {"ingest_docs_per_sec": options.docs / seconds}
+    metrics.update(await measure_lookups(module, keys))
+    return metrics
+
+
+# Benchmark: sharded ingest, lookups, then draining one node and adding another
+async def bench_multinode(options, node_count, batch_size, processes):
+    backend = options.backend()
+    module = load_script("multinode", backend, node_count)
+    await quietly(module.ensure_ring_hash_index())
+    _, seconds = await timed(module.insert_documents(options.docs, batch_size, processes=processes))
+    keys = [str(key) for key in random.Random(options.seed).sample(range(options.docs),
+                                                                    min(options.lookups, options.docs))]
+    metrics = {"ingest_docs_per_sec": options.docs / seconds}
+    metrics.update(await measure_lookups(module, keys))
+
+    removed_node = module.mongodb_nodes[-1]
+    moved = (await count_documents(module))[f"{removed_node['host']}:{removed_node['port']}"]
+    _, seconds = await timed(module.remove_node_and_migrate_data(removed_node["host"], removed_node["port"]))
+    metrics["remove_node_docs_per_sec"] = moved / seconds
+
+    added_port = first_port + node_count
+    _, seconds = await timed(module.add_node_and_migrate_data("localhost", added_port))
+    moved = (await count_documents(module))[f"localhost:{added_port}"]
+    metrics["add_node_docs_per_sec"] = moved / seconds
+
+    if sum((await count_documents(module)).values()) != options.docs:
+        raise RuntimeError("multinode benchmark lost or duplicated documents during migration")
+    return metrics
+
+
+# Benchmark: replicated ingest under N/W settings, lookups, and restoring a node by hint replay and by full sync
+async def bench_backup(options, node_count, batch_size, n, w):
+    backend = options.backend()
+    module = load_script("multinode-with-backup", backend, node_count)
+    await quietly(module.ensure_indexes())
+    _, seconds = await timed(module.insert_documents_with_backup(options.docs, batch_size=batch_size, n=n, w=w))
+    keys = [str(key) for key in random.Random(options.seed).sample(range(options.docs),
+                                                                    min(options.lookups, options.docs))]
+    metrics = {"ingest_docs_per_sec": options.docs / seconds}
+    metrics.update(await measure_lookups(module, keys))
+
+    down_node = f"localhost:{first_port + 1}"
+    written_while_down = max(1, options.docs // 10)
+    with silenced():
+        module.take_down_node(down_node)
+    await quietly(module.insert_documents_with_backup(written_while_down, start_id=options.docs,
+                                                      batch_size=batch_size, n=n, w=1))
+    _, seconds = await timed(module.restore_node_and_sync(down_node))
+    metrics["restore_hinted_seconds"] = seconds
+
+    with silenced():
+        module.take_down_node(down_node)
+    _, seconds = await timed(module.restore_node_and_sync(down_node, full_sync=True))
+    metrics["restore_full_sync_seconds"] = seconds
+    return metrics
+
+
+# Async function to run every benchmark in the grid and collect one record per parameter set
+async def run_grid(options):
+    records = []
+
+    async def record(suite, params, benchmark):
+        print(f"{suite} {params} ...", end=" ", flush=True)
+        metrics = await benchmark
+        print(", ".join(f"{name}={value:.4g}" for name, value in metrics.items()))
+        records.append({"suite": suite, "params": params, "metrics": metrics})
+
+    for batch_size in options.batch_sizes:
+        await record("single-node", {"batch_size": batch_size}, bench_single_node(options, batch_size))
+    for node_count in options.nodes:
+        for batch_size in options.batch_sizes:
+            for processes in options.processes:
+                await record("multinode", {"nodes": node_count, "batch_size": batch_size, "processes": processes},
+                             bench_multinode(options, node_count, batch_size, processes))
+    for node_count in options.nodes:
+        for n, w in options.replication:
+            if n > node_count:
+                continue
+            batch_size = options.batch_sizes[-1]
+            await record("multinode-with-backup", {"nodes": node_count, "batch_size": batch_size, "n": n, "w": w},
+                         bench_backup(options, node_count, batch_size, n, w))
+    return records
+
+
+# Function to compare results against a baseline file, returning the metrics that got worse than the tolerance
+def find_regressions(records, baseline, tolerance):
+    baseline_records = {(record["suite"], json.dumps(record["params"], sort_keys=True)): record["metrics"]
+                        for record in baseline["results"]}
+    regressions = []
+    for record in records:
+        previous = baseline_records.get((record["suite"], json.dumps(record["params"], sort_keys=True)))
+        if not previous:
+            continue
+        for name, value in record["metrics"].items():
+            if name not in previous or not previous[name]:
+                continue
+            # Rates should not drop; latencies and durations should not grow
+            change = (value - previous[name]) / previous[name]
+            worse = -change if name.endswith("_per_sec") else change
+            if worse > tolerance:
+                regressions.append(f"{record['suite']} {record['params']} {name}: "
+                                   f"{previous[name]:.4g} -> {value:.4g} ({worse:+.0%} worse)")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--docs", type=int, default=20000, help="documents inserted per benchmark")
+    parser.add_argument("--lookups", type=int, default=500, help="keys sampled for lookup latency")
+    parser.add_argument("--nodes", type=lambda value: [int(v) for v in value.split(",")], default=[3, 5])
+    parser.add_argument("--batch-sizes", type=lambda value: [int(v) for v in value.split(",")], default=[1000, 10000])
+    parser.add_argument("--processes", type=lambda value: [int(v) for v in value.split(",")], default=[1],
+                        help="producer processes for the multinode ingest")
+    parser.add_argument("--replication", default="2:1,2:2,3:2", help="comma separated N:W pairs")
+    parser.add_argument("--latency", type=float, default=0.2, help="simulated round trip in milliseconds")
+    parser.add_argument("--jitter", type=float, default=0.5, help="random extra latency as a fraction of it")
+    parser.add_argument("--per-document-latency", type=float, default=0.5, help="microseconds per document moved")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write JSON results to this file")
+    parser.add_argument("--baseline", help="JSON results to compare against; exits 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    options = parser.parse_args(argv)
+    options.replication = [tuple(int(v) for v in pair.split(":")) for pair in options.replication.split(",")]
+    options.backend = lambda: MemoryBackend(options.latency / 1000, options.jitter,
+                                            options.per_document_latency / 1e6, options.seed)
+    return options
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    records = asyncio.run(run_grid(options))
+    results = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "settings": {"docs": options.docs, "lookups": options.lookups, "latency_ms": options.latency,
+                     "jitter": options.jitter, "per_document_latency_us": options.per_document_latency,
+                     "seed": options.seed},
+        "results": records,
+    }
+    if options.output:
+        with open(options.output, "w") as output:
+            json.dump(results, output, indent=2)
+        print(f"Results written to {options.output}")
+
+    if options.baseline:
+        with open(options.baseline) as baseline:
+            regressions = find_regressions(records, json.load(baseline), options.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print("No regressions against the baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
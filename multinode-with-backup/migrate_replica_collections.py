@@ -0,0 +1,28 @@
+"""Re-file backups flagged with is_backup in mycollection under each key's preference list (run once)."""
+import argparse
+import asyncio
+import sys
+
+import ring_with_backup as ring
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batch-size", type=int, default=10000, help="backups moved per round trip")
+    return parser.parse_args(argv)
+
+
+async def migrate(options):
+    await ring.client_manager.warm_up()
+    await ring.migrate_to_replica_collections(options.batch_size)
+    await ring.check_data_consistency()
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    asyncio.run(migrate(options))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,16 @@
 import asyncio
+import json
+import math
+import os
+from bisect import bisect
+from collections import OrderedDict
+from hashlib import md5
+import bson
+from bson.raw_bson import DEFAULT_RAW_BSON_OPTIONS
 from uhashring import HashRing
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError
 import time
 
 # MongoDB nodes (simulating multiple MongoDB instances)
@@ -13,80 +23,840 @@ mongodb_nodes = [
 # Initialize HashRing with MongoDB nodes
 hash_ring = HashRing(nodes=[f"{node['host']}:{node['port']}" for node in mongodb_nodes])
 
-# Initialize MongoDB clients asynchronously
+
+# Connection pool settings for every node: pool bounds, and how long to wait before calling a node unreachable
+max_pool_size = 100
+min_pool_size = 10
+connect_timeout_ms = 2000
+server_selection_timeout_ms = 2000
+
+
+# Function to connect to a storage node; swap it for another backend returning a Motor-compatible client
+def create_client(host, port):
+    return AsyncIOMotorClient(host, port, maxPoolSize=max_pool_size, minPoolSize=min_pool_size,
+                              connectTimeoutMS=connect_timeout_ms,
+                              serverSelectionTimeoutMS=server_selection_timeout_ms)
+
+
+# Circuit breaker for one node: opens after consecutive failures, then lets one trial call through per reset_timeout
+class CircuitBreaker:
+    def __init__(self, failure_threshold=3, reset_timeout=5.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def allow_request(self):
+        if self.state == "closed":
+            return True
+        now = time.monotonic()
+        if now - self.opened_at >= self.reset_timeout:
+            self.state = "half-open"
+            self.opened_at = now
+            return True
+        return False
+
+    # Returns True when the call closed a breaker that was open
+    def record_success(self):
+        recovered = self.state != "closed"
+        self.state = "closed"
+        self.failures = 0
+        return recovered
+
+    # Returns True when the call opened the breaker
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half-open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+
+# Warm clients for every node the ring has known, with a circuit breaker and periodic health checks per node
+class ClientManager:
+    def __init__(self, failure_threshold=3, reset_timeout=5.0, request_timeout=2.0, health_check_interval=5.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.request_timeout = request_timeout
+        self.health_check_interval = health_check_interval
+        self.clients = {}
+        self.breakers = {}
+        self.health_task = None
+
+    # Return the node's client, connecting only the first time it is asked for
+    def client(self, node_key):
+        if node_key not in self.clients:
+            host, port = node_key.split(":")
+            self.clients[node_key] = create_client(host, int(port))
+        return self.clients[node_key]
+
+    def breaker(self, node_key):
+        if node_key not in self.breakers:
+            self.breakers[node_key] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+        return self.breakers[node_key]
+
+    # A node takes calls while it is in service and its breaker is not open
+    def available(self, node_key):
+        return node_key in mongo_clients and self.breaker(node_key).allow_request()
+
+    # Function to get the first replica of a key that can take calls, skipping the nodes already tried
+    def route(self, key, tried=()):
+        for node in preference_list(key, replication_factor):
+            if node not in tried and self.available(node):
+                return node
+        return None
+
+    def record_success(self, node_key):
+        if self.breaker(node_key).record_success():
+            metrics.gauge("circuit_open", node_key, 0)
+            print(f"Circuit for {node_key} closed")
+            return True
+        return False
+
+    def record_failure(self, node_key):
+        if self.breaker(node_key).record_failure():
+            metrics.gauge("circuit_open", node_key, 1)
+            metrics.count("circuit_opened", node_key)
+            print(f"Circuit for {node_key} opened; calls go to its ring successors")
+
+    # Async function to run operation(client) against a node within request_timeout, feeding the node's breaker
+    async def call(self, node_key, operation):
+        try:
+            result = await asyncio.wait_for(operation(self.client(node_key)), self.request_timeout)
+        except asyncio.CancelledError:
+            raise
+        except BulkWriteError:
+            self.record_success(node_key)  # The node answered and only rejected some of the documents
+            raise
+        except Exception:
+            self.record_failure(node_key)
+            raise
+        self.record_success(node_key)
+        return result
+
+    # Async function to ping a node; returns True if it answered in time
+    async def ping(self, node_key):
+        start_time = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.client(node_key)['admin'].command("ping"), self.request_timeout)
+        except Exception:
+            return False
+        metrics.observe("health_check", node_key, time.perf_counter() - start_time)
+        return True
+
+    # Async function to open min_pool_size connections to every node up front, so the first requests skip the handshakes
+    async def warm_up(self, node_keys=None):
+        node_keys = list(node_keys or mongo_clients)
+        results = await asyncio.gather(*(self.ping(node_key) for node_key in node_keys
+                                         for _ in range(max(1, min_pool_size))))
+        for index, node_key in enumerate(node_keys):
+            answered = results[index * max(1, min_pool_size):(index + 1) * max(1, min_pool_size)]
+            if all(answered):
+                self.record_success(node_key)
+            else:
+                print(f"Node {node_key} did not answer during warm-up")
+                self.record_failure(node_key)
+
+    # Async function to ping every known node, replaying hints kept for nodes whose breaker closes again
+    async def check_health(self):
+        node_keys = list(self.clients)
+        for node_key, answered in zip(node_keys, await asyncio.gather(*(self.ping(node) for node in node_keys))):
+            if not answered:
+                self.record_failure(node_key)
+            elif self.record_success(node_key) and node_key in mongo_clients:
+                await replay_hints(node_key)
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            try:
+                await self.check_health()
+            except Exception as e:
+                print(f"Error during health checks: {e}")
+
+    def start_health_checks(self):
+        if self.health_task is None:
+            self.health_task = asyncio.create_task(self._health_loop())
+
+    async def stop_health_checks(self):
+        if self.health_task is not None:
+            self.health_task.cancel()
+            try:
+                await self.health_task
+            except asyncio.CancelledError:
+                pass
+            self.health_task = None
+
+
+# Clients and circuit breakers for every node, kept warm while a node is out of service
+client_manager = ClientManager()
+
+# Nodes in service and their clients
 mongo_clients = {
-    f"{node['host']}:{node['port']}": AsyncIOMotorClient(node["host"], node["port"]) for node in mongodb_nodes
+    f"{node['host']}:{node['port']}": client_manager.client(f"{node['host']}:{node['port']}") for node in mongodb_nodes
 }
 
 
-# Function to get the next node in the hash ring
-def get_next_node(node_key):
-    nodes = list(hash_ring.nodes)
-    current_index = nodes.index(node_key)
-    next_index = (current_index + 1) % len(nodes)
-    return nodes[next_index]
+# Latency histogram with log-linear buckets (16 per power of two, about 6% wide): recording is one frexp and a dict update
+class LatencyHistogram:
+    sub_buckets = 16
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        mantissa, exponent = math.frexp(max(seconds, 1e-9))
+        bucket = exponent * self.sub_buckets + int((mantissa - 0.5) * 2 * self.sub_buckets)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def upper_bound(self, bucket):
+        exponent, sub_bucket = divmod(bucket, self.sub_buckets)
+        return math.ldexp(0.5 + (sub_bucket + 1) / (2 * self.sub_buckets), exponent)
+
+    def quantile(self, fraction):
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= fraction * self.count:
+                return min(self.upper_bound(bucket), self.max)
+        return self.max
+
+
+# Counters, gauges and latency histograms keyed by (name, node), exported as Prometheus text or JSON
+class Metrics:
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def count(self, name, node="", value=1):
+        self.counters[(name, node)] = self.counters.get((name, node), 0) + value
+
+    def gauge(self, name, node, value):
+        self.gauges[(name, node)] = value
+
+    def observe(self, name, node, seconds):
+        histogram = self.histograms.get((name, node))
+        if histogram is None:
+            histogram = self.histograms[(name, node)] = LatencyHistogram()
+        histogram.record(seconds)
+
+    def clear(self):
+        self.counters.clear()
+        self.gauges.clear()
+        self.histograms.clear()
+
+    def snapshot(self):
+        return {
+            "counters": [{"name": name, "node": node, "value": value}
+                         for (name, node), value in sorted(self.counters.items())],
+            "gauges": [{"name": name, "node": node, "value": value}
+                       for (name, node), value in sorted(self.gauges.items())],
+            "histograms": [{"name": name, "node": node, "count": histogram.count, "sum": histogram.sum,
+                            "max": histogram.max, "p50": histogram.quantile(0.5), "p90": histogram.quantile(0.9),
+                            "p99": histogram.quantile(0.99)}
+                           for (name, node), histogram in sorted(self.histograms.items())],
+        }
+
+    def export(self, format="prometheus"):
+        if format == "json":
+            return json.dumps(self.snapshot(), indent=2)
+
+        def labels(node, **extra):
+            pairs = ([("node", node)] if node else []) + list(extra.items())
+            return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}" if pairs else ""
+
+        lines = []
+        for kind, suffix, values in (("counter", "_total", self.counters), ("gauge", "", self.gauges)):
+            for name in sorted({name for name, _ in values}):
+                lines.append(f"# TYPE ring_{name}{suffix} {kind}")
+                lines.extend(f"ring_{name}{suffix}{labels(node)} {value}"
+                             for (metric, node), value in sorted(values.items()) if metric == name)
+        for name in sorted({name for name, _ in self.histograms}):
+            lines.append(f"# TYPE ring_{name}_seconds histogram")
+            for (metric, node), histogram in sorted(self.histograms.items()):
+                if metric != name:
+                    continue
+                seen = 0
+                for bucket in sorted(histogram.counts):
+                    seen += histogram.counts[bucket]
+                    lines.append(f"ring_{name}_seconds_bucket{labels(node, le=f'{histogram.upper_bound(bucket):.6g}')} {seen}")
+                lines.append(f"ring_{name}_seconds_bucket{labels(node, le='+Inf')} {histogram.count}")
+                lines.append(f"ring_{name}_seconds_sum{labels(node)} {histogram.sum}")
+                lines.append(f"ring_{name}_seconds_count{labels(node)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def report(self):
+        print("\nOperation Latency:")
+        for (name, node), histogram in sorted(self.histograms.items()):
+            print(f"{name}{' ' + node if node else ''}: {histogram.count} ops, p50 {histogram.quantile(0.5) * 1000:.2f} ms, "
+                  f"p99 {histogram.quantile(0.99) * 1000:.2f} ms, max {histogram.max * 1000:.2f} ms")
+
+
+# Metrics for every node and operation in this process
+metrics = Metrics()
+
+
+# Preference lists cached per vnode position, reset whenever uhashring replaces its sorted key list
+_preference_cache = {"keys": None, "lists": {}}
+
+
+# Function to get the N distinct nodes responsible for a key, walking the ring clockwise
+def preference_list(key, n=2):
+    """Return up to n distinct nodes clockwise from the key's hash; the first one is the primary."""
+    ring_keys = hash_ring._keys
+    if not ring_keys:
+        return ()
+    if _preference_cache["keys"] is not ring_keys:
+        _preference_cache["keys"] = ring_keys
+        _preference_cache["lists"] = {}
+
+    position = bisect(ring_keys, hash_ring.hashi(key))
+    if position == len(ring_keys):
+        position = 0
+
+    # Every key between two consecutive vnodes shares the same preference list
+    nodes = _preference_cache["lists"].get((position, n))
+    if nodes is None:
+        nodes = []
+        for offset in range(len(ring_keys)):
+            node = hash_ring.ring[ring_keys[(position + offset) % len(ring_keys)]]
+            if node not in nodes:
+                nodes.append(node)
+                if len(nodes) == n:
+                    break
+        nodes = tuple(nodes)
+        _preference_cache["lists"][(position, n)] = nodes
+    return nodes
+
+
+# Function to get the ring position of a key as the fixed-width hex string stored in "ring_hash"
+def ring_hash(key):
+    # uhashring positions are the md5 digest read as an integer, so hex order matches ring order
+    return md5(str(key).encode("utf-8")).hexdigest()
+
+
+# Function to get the collection a node keeps a source node's keys in: "mycollection" for its own primaries,
+# and one replica collection per source node for backups, so the two copies of a key never share an _id index
+def collection_name(node, source):
+    if node == source:
+        return "mycollection"
+    return "replica_" + source.replace(".", "_").replace(":", "_")
+
+
+# Function to get the collection a node stores its copy of a key in; the key's primary is the source
+def key_collection_name(node, key):
+    return collection_name(node, preference_list(key, 1)[0])
+
+
+# Function to group keys a node holds by the collection each one is stored in
+def group_keys_by_collection(node, keys):
+    grouped_keys = {}
+    for key in keys:
+        grouped_keys.setdefault(key_collection_name(node, key), []).append(key)
+    return grouped_keys
+
+
+# Function to get the names of every collection a node may hold data in: its primaries, then a replica per source
+def node_collection_names(node):
+    return ["mycollection"] + [collection_name(node, source) for source in hash_ring.get_nodes() if source != node]
+
+
+# Async function to index the stored ring position and the hinted handoff queue on every node
+async def ensure_indexes():
+    for node_key, client in mongo_clients.items():
+        for name in node_collection_names(node_key):
+            await client['mydatabase'][name].create_index("ring_hash")
+        await client['mydatabase']['hints'].create_index("node")
+
+
+# Depth of the anti-entropy hash trees; the leaves split the ring into 2 ** depth equal hash ranges
+hash_tree_depth = 10
+
+
+# Anti-entropy hash tree over one node's documents in one role, with leaves keyed by ring range
+class HashTree:
+    def __init__(self, depth=hash_tree_depth):
+        self.depth = depth
+        self.levels = [[0] * (2 ** level) for level in range(depth + 1)]
+
+    # Fold a document digest into (or back out of) its leaf and every ancestor; XOR makes both the same operation
+    def toggle(self, leaf, digest):
+        for level in range(self.depth, -1, -1):
+            self.levels[level][leaf] ^= digest
+            leaf >>= 1
+
+    # Return the leaves that differ from another tree, descending only into subtrees that differ
+    def diff(self, other):
+        candidates = [0]
+        for level in range(self.depth + 1):
+            differing = [i for i in candidates if self.levels[level][i] != other.levels[level][i]]
+            if level == self.depth:
+                return differing
+            candidates = [child for i in differing for child in (2 * i, 2 * i + 1)]
+
+
+# Hash trees keyed by (node, "primary" or "backup", partner node holding the other copy); a primary has one tree
+# per replica in its keys' preference lists, and each replica one tree per primary it backs up
+hash_trees = {}
+
+
+# Function to get the 64-bit content digest of a document, ignoring the is_backup flag of the old layout
+def document_digest(document):
+    content = {field: value for field, value in sorted(document.items()) if field != "is_backup"}
+    return int.from_bytes(md5(bson.encode(content)).digest()[:8], "big")
+
+
+# Function to get the hash tree leaf covering a key's ring position
+def hash_tree_leaf(key):
+    return int(ring_hash(key), 16) >> (128 - hash_tree_depth)
+
+
+# Function to build the ring_hash filter for a hash tree leaf
+def hash_tree_leaf_range(leaf):
+    shift = 128 - hash_tree_depth
+    bounds = {"$gte": f"{leaf << shift:032x}"}
+    if leaf + 1 < 2 ** hash_tree_depth:
+        bounds["$lt"] = f"{(leaf + 1) << shift:032x}"
+    return {"ring_hash": bounds}
+
+
+# Function to fold documents a node has acknowledged into its hash trees; copies outside the preference list are skipped
+def record_written(node, documents):
+    for document in documents:
+        nodes = preference_list(document["_id"], replication_factor)
+        leaf, digest = hash_tree_leaf(document["_id"]), document_digest(document)
+        if nodes[0] == node:
+            for replica in nodes[1:]:
+                hash_trees.setdefault((node, "primary", replica), HashTree()).toggle(leaf, digest)
+        elif node in nodes:
+            hash_trees.setdefault((node, "backup", nodes[0]), HashTree()).toggle(leaf, digest)
+
+
+# Async function to add the ring position to a node's documents stored before it was kept, primaries and backups alike
+async def backfill_ring_hash(node_key, batch_size=10000):
+    for name in node_collection_names(node_key):
+        collection = mongo_clients[node_key]['mydatabase'][name]
+        updates = []
+        async for document in collection.find({"ring_hash": {"$exists": False}}, {"_id": 1}):
+            updates.append(UpdateOne({"_id": document["_id"]}, {"$set": {"ring_hash": ring_hash(document["_id"])}}))
+            if len(updates) == batch_size:
+                await collection.bulk_write(updates, ordered=False)
+                updates = []
+        if updates:
+            await collection.bulk_write(updates, ordered=False)
+
+
+# Async function to rebuild a node's hash trees from the data it actually holds
+async def rebuild_hash_trees(node_key, batch_size=10000):
+    # Ranges are repaired by ring_hash, so documents stored without it would be counted but never found
+    await backfill_ring_hash(node_key, batch_size)
+    for tree_key in [tree_key for tree_key in hash_trees if tree_key[0] == node_key]:
+        del hash_trees[tree_key]
+    documents = []
+    for name in node_collection_names(node_key):
+        async for document in mongo_clients[node_key]['mydatabase'][name].find({}):
+            documents.append(document)
+            if len(documents) == batch_size:
+                record_written(node_key, documents)
+                documents = []
+    record_written(node_key, documents)
+
+
+# Async function to reconcile one hash range between a primary node and the node holding its backups
+async def repair_hash_range(node, backup_node, leaf):
+    collection = mongo_clients[node]['mydatabase']['mycollection']
+    backup_collection = mongo_clients[backup_node]['mydatabase'][collection_name(backup_node, node)]
+    leaf_range = hash_tree_leaf_range(leaf)
+
+    # Hash ranges do not line up with vnodes, so keep only the keys this node is primary for and backup_node replicates
+    def replicated_by_pair(key):
+        nodes = preference_list(key, replication_factor)
+        return nodes[0] == node and backup_node in nodes[1:]
+
+    primaries = {document["_id"]: document async for document in collection.find(leaf_range)
+                 if replicated_by_pair(document["_id"])}
+    backups = {document["_id"]: document async for document in backup_collection.find(leaf_range)
+               if replicated_by_pair(document["_id"])}
+
+    # Primary copies win; keys that only survived as a backup are copied back to the primary
+    backup_repairs = [document for key, document in primaries.items()
+                      if key not in backups or document_digest(backups[key]) != document_digest(document)]
+    primary_repairs = [document for key, document in backups.items() if key not in primaries]
+
+    if backup_repairs:
+        await backup_collection.bulk_write([ReplaceOne({"_id": doc["_id"]}, doc, upsert=True)
+                                            for doc in backup_repairs], ordered=False)
+        record_written(backup_node, [backups[doc["_id"]] for doc in backup_repairs if doc["_id"] in backups])
+        record_written(backup_node, backup_repairs)
+    if primary_repairs:
+        await collection.insert_many(primary_repairs, ordered=False)
+        record_written(node, primary_repairs)
+    return len(backup_repairs) + len(primary_repairs)
+
+
+# Async function to compare every primary tree with its backup tree and repair only the ranges that differ
+async def anti_entropy():
+    # The trees are kept in memory by the process that did the writes; nodes without any are read back first
+    for node_key in mongo_clients:
+        if not any(tree_key[0] == node_key for tree_key in hash_trees):
+            await rebuild_hash_trees(node_key)
+    pairs = {(node, partner) if role == "primary" else (partner, node) for node, role, partner in hash_trees}
+    repaired_count = 0
+    for node, backup_node in sorted(pairs):
+        if node not in mongo_clients or backup_node not in mongo_clients:
+            continue
+        tree = hash_trees.setdefault((node, "primary", backup_node), HashTree())
+        backup_tree = hash_trees.setdefault((backup_node, "backup", node), HashTree())
+        leaves = tree.diff(backup_tree)
+        if leaves:
+            print(f"Anti-entropy: {len(leaves)} of {2 ** hash_tree_depth} ranges differ between "
+                  f"{node} and its backups on {backup_node}")
+        for leaf in leaves:
+            leaf_repairs = await repair_hash_range(node, backup_node, leaf)
+            metrics.count("anti_entropy_repairs", node, leaf_repairs)
+            repaired_count += leaf_repairs
+    print(f"Anti-entropy repaired {repaired_count} documents")
+    return repaired_count
+
+
+# Per-node bulk writers: one bounded queue per node drained by a fixed number of in-flight insert_many calls
+class NodeWriters:
+    def __init__(self, clients, max_in_flight=2, queue_size=4, on_written=None):
+        self.clients = clients
+        self.on_written = on_written
+        self.max_in_flight = max_in_flight
+        self.queues = {node: asyncio.Queue(maxsize=queue_size) for node in clients}
+        self.stats = {node: {"batches": 0, "documents": 0, "errors": 0} for node in clients}
+        self.workers = []
+        self.start_time = None
+
+    def start(self):
+        self.start_time = time.time()
+        for node, queue in self.queues.items():
+            for _ in range(self.max_in_flight):
+                self.workers.append(asyncio.create_task(self._worker(node, queue)))
+        return self
+
+    async def _worker(self, node, queue):
+        while True:
+            item = await queue.get()
+            try:
+                if item is None:
+                    return
+                documents, name, written = item
+                start_time = time.perf_counter()
+                try:
+                    # Bounded by the request timeout, so a slow node fails the batch instead of holding the write
+                    await client_manager.call(
+                        node, lambda client: client['mydatabase'][name].insert_many(documents, ordered=False))
+                except BulkWriteError as e:
+                    # Unordered inserts keep going past failures, so the rest of the batch still landed
+                    failed = {error["index"] for error in e.details["writeErrors"]}
+                    self.stats[node]["errors"] += 1
+                    metrics.count("insert_errors", node)
+                    if self.on_written:
+                        self.on_written(node, [doc for index, doc in enumerate(documents) if index not in failed])
+                    written.set_exception(e)
+                    continue
+                except Exception as e:
+                    self.stats[node]["errors"] += 1
+                    metrics.count("insert_errors", node)
+                    written.set_exception(e)
+                    continue
+                metrics.observe("insert_batch", node, time.perf_counter() - start_time)
+                metrics.count("documents_inserted", node, len(documents))
+                self.stats[node]["batches"] += 1
+                self.stats[node]["documents"] += len(documents)
+                if self.on_written:
+                    self.on_written(node, documents)
+                written.set_result(len(documents))
+            finally:
+                queue.task_done()
+
+    # Queue a batch for one of a node's collections, waiting while the node's queue is full;
+    # the returned future resolves once it is written
+    async def submit(self, node, documents, name="mycollection"):
+        written = asyncio.get_running_loop().create_future()
+        await self.queues[node].put((documents, name, written))
+        metrics.gauge("writer_queue_depth", node, self.queues[node].qsize())
+        await asyncio.sleep(0)  # Let the node's workers pick the batch up
+        return written
+
+    # Wait for every queued batch to be written, then stop the workers
+    async def close(self):
+        for queue in self.queues.values():
+            for _ in range(self.max_in_flight):
+                await queue.put(None)
+        await asyncio.gather(*self.workers)
+        self.workers = []
+
+    def report(self):
+        elapsed_time = max(time.time() - self.start_time, 1e-9)
+        print("\nWriter Throughput:")
+        for node, stats in self.stats.items():
+            print(f"Node: {node} -> {stats['documents']} documents in {stats['batches']} batches, "
+                  f"{stats['documents'] / elapsed_time:.0f} docs/sec, {stats['errors']} failed batches")
+
+
+# Replication defaults: N copies of every key, W acknowledgements per write, R answers per read
+replication_factor = 2
+write_quorum = 2
+read_quorum = 1
+
+# Replica writes still running after their quorum was reached
+_replication_tasks = set()
+
+
+class QuorumError(Exception):
+    pass
+
+
+# Async function to write one node's share of a replicated batch to one collection and return the keys it acknowledged
+async def write_replica(node, documents, writers=None, name="mycollection"):
+    if not client_manager.available(node):
+        return await write_hints(node, documents)
+    try:
+        if writers is not None:
+            await (await writers.submit(node, documents, name))
+        else:
+            await client_manager.call(node, lambda client: client['mydatabase'][name].insert_many(documents,
+                                                                                                 ordered=False))
+            record_written(node, documents)
+    except BulkWriteError as e:
+        errors = e.details["writeErrors"]
+        if writers is None:
+            rejected = {error["index"] for error in errors}
+            record_written(node, [doc for index, doc in enumerate(documents) if index not in rejected])
+        # A duplicate key means the replica already holds the document
+        failed = {error["index"] for error in errors if error["code"] != 11000}
+        return {doc["_id"] for index, doc in enumerate(documents) if index not in failed}
+    except Exception as e:
+        # client_manager.call already counted the failure against the node's breaker
+        print(f"Error writing replicas to {node}: {e!r}")
+        return set()
+    return {doc["_id"] for doc in documents}
+
+
+# Nodes taken down while writes meant for them are kept as hints
+hinted_nodes = set()
+
+# Local append-only log of BSON hints, used when no stand-in node is reachable
+hint_log_path = "hints.log"
+
+
+# Async function to keep writes for an unavailable node as hints on the next healthy node of each key's ring walk
+async def write_hints(node, documents):
+    hints = {}
+    for document in documents:
+        nodes = preference_list(document["_id"], len(hash_ring.get_nodes()))
+        position = nodes.index(node) if node in nodes else 0
+        stand_ins = [stand_in for stand_in in nodes[position + 1:] + nodes[:position]
+                     if client_manager.available(stand_in)]
+        hints.setdefault(stand_ins[0] if stand_ins else None, []).append({"node": node, "document": document})
+
+    acknowledged = set()
+    for stand_in, node_hints in hints.items():
+        try:
+            if stand_in is None:
+                with open(hint_log_path, "ab") as hint_log:
+                    hint_log.write(b"".join(bson.encode(hint) for hint in node_hints))
+            else:
+                await mongo_clients[stand_in]['mydatabase']['hints'].insert_many(node_hints, ordered=False)
+        except Exception as e:
+            print(f"Error writing hints for {node} to {stand_in or hint_log_path}: {e}")
+            continue
+        metrics.count("hints_written", node, len(node_hints))
+        acknowledged.update(hint["document"]["_id"] for hint in node_hints)
+    return acknowledged
+
+
+# Async function to apply a batch of hinted documents to the node they were meant for, primaries and backups alike
+async def apply_hints(node_key, documents):
+    grouped_documents = {}
+    for document in documents:
+        grouped_documents.setdefault(key_collection_name(node_key, document["_id"]), []).append(document)
+    for name, name_documents in grouped_documents.items():
+        try:
+            await mongo_clients[node_key]['mydatabase'][name].insert_many(name_documents, ordered=False)
+        except BulkWriteError as e:
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+            rejected = {error["index"] for error in e.details["writeErrors"]}
+            name_documents = [doc for index, doc in enumerate(name_documents) if index not in rejected]
+        record_written(node_key, name_documents)
+
+
+# Async function to replay every hint kept for a node, in bulk, and drop the hints once applied
+async def replay_hints(node_key, batch_size=10000):
+    replayed_count = 0
+    for stand_in, client in mongo_clients.items():
+        if stand_in == node_key:
+            continue
+        # Hinted documents are forwarded as the raw BSON they were stored as
+        hints_collection = client['mydatabase']['hints'].with_options(codec_options=DEFAULT_RAW_BSON_OPTIONS)
+        while True:
+            # Applied hints are deleted, so each query picks up the next batch
+            hints = await hints_collection.find({"node": node_key}).to_list(batch_size)
+            if not hints:
+                break
+            start_time = time.perf_counter()
+            await apply_hints(node_key, [hint["document"] for hint in hints])
+            await hints_collection.delete_many({"_id": {"$in": [hint["_id"] for hint in hints]}})
+            metrics.observe("restore_batch", node_key, time.perf_counter() - start_time)
+            metrics.count("hints_replayed", node_key, len(hints))
+            replayed_count += len(hints)
+        print(f"Replayed hints for {node_key} from {stand_in}: {replayed_count} so far")
+
+    if os.path.exists(hint_log_path):
+        with open(hint_log_path, "rb") as hint_log:
+            logged_hints = list(bson.decode_file_iter(hint_log))
+        documents = [hint["document"] for hint in logged_hints if hint["node"] == node_key]
+        for i in range(0, len(documents), batch_size):
+            start_time = time.perf_counter()
+            await apply_hints(node_key, documents[i:i + batch_size])
+            metrics.observe("restore_batch", node_key, time.perf_counter() - start_time)
+        metrics.count("hints_replayed", node_key, len(documents))
+        remaining_hints = [hint for hint in logged_hints if hint["node"] != node_key]
+        with open(hint_log_path, "wb") as hint_log:
+            hint_log.write(b"".join(bson.encode(hint) for hint in remaining_hints))
+        replayed_count += len(documents)
+    return replayed_count
+
+
+# Async function to write documents to N replicas concurrently and return once W replicas of every key confirmed
+async def quorum_write(documents, n=None, w=None, writers=None):
+    n = n or replication_factor
+    w = w or write_quorum
+    if w > n:
+        raise ValueError(f"A write quorum of {w} needs at least {w} replicas, but N is {n}")
+    start_time = time.perf_counter()
+
+    # The first node of each preference list holds the primary copy, the rest hold backups in its replica collection
+    replica_documents = {}
+    required_acks = {}
+    for document in documents:
+        nodes = preference_list(document["_id"], n)
+        required_acks[document["_id"]] = w
+        for node in nodes:
+            replica_documents.setdefault((node, collection_name(node, nodes[0])), []).append(document)
+
+    pending = {asyncio.create_task(write_replica(node, node_documents, writers, name))
+               for (node, name), node_documents in replica_documents.items()}
+    waiting = {key for key, required in required_acks.items() if required > 0}
+    try:
+        while waiting and pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                for key in task.result():
+                    required_acks[key] -= 1
+                    if required_acks[key] == 0:
+                        waiting.discard(key)
+    finally:
+        # Slower replicas keep writing in the background once the quorum is met
+        _replication_tasks.update(pending)
+        for task in pending:
+            task.add_done_callback(_replication_tasks.discard)
+
+    metrics.observe("quorum_write", "", time.perf_counter() - start_time)
+    if waiting:
+        metrics.count("quorum_write_failures", value=len(waiting))
+        raise QuorumError(f"{len(waiting)} of {len(documents)} keys did not reach a write quorum of {w}")
+
+
+# Async function to read a key from N replicas and return as soon as R of them answer
+async def quorum_read(key, n=None, r=None):
+    n = n or replication_factor
+    r = r or read_quorum
+    if r > n:
+        raise ValueError(f"A read quorum of {r} needs at least {r} replicas, but N is {n}")
+    replicas = [node for node in preference_list(key, n) if client_manager.available(node)]
+    start_time = time.perf_counter()
+
+    async def read_replica(node):
+        return node, await client_manager.call(
+            node, lambda client: client['mydatabase'][key_collection_name(node, key)].find_one({"_id": key}))
+
+    pending = {asyncio.create_task(read_replica(node)) for node in replicas}
+    answers = {}
+    try:
+        while pending and len(answers) < r:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    node, document = task.result()
+                    answers[node] = document
+    finally:
+        for task in pending:
+            task.cancel()
+
+    metrics.observe("quorum_read", "", time.perf_counter() - start_time)
+    if len(answers) < r:
+        metrics.count("quorum_read_failures")
+        raise QuorumError(f"Only {len(answers)} of {len(replicas)} replicas answered for key '{key}', needed {r}")
+
+    # Without versions the primary copy wins whenever it is among the answers
+    documents = [answers[node] for node in replicas if answers.get(node)]
+    return documents[0] if documents else None
+
 
 # Async function to insert documents into MongoDB with backup
-async def insert_documents_with_backup(num_docs, start_id=0, batch_size=100000):
+async def insert_documents_with_backup(num_docs, start_id=0, batch_size=100000, max_in_flight=2, queue_size=4,
+                                       n=None, w=None):
+    n = n or replication_factor
     start_time = time.time()
-    documents_dict = {node: [] for node in mongo_clients}
-    backup_documents_dict = {node: [] for node in mongo_clients}
-    key_ranges = {node: {"min": None, "max": None, "count": 0, "backup_count": 0} for node in mongo_clients}
+    writers = NodeWriters(mongo_clients, max_in_flight, queue_size, on_written=record_written).start()
+    documents = []
+    in_flight = []
+    key_ranges = {node: {"min": None, "max": None, "count": 0, "backup_count": 0} for node in hash_ring.get_nodes()}
 
     for i in range(start_id, start_id + num_docs):
         key = str(i)  # Generate unique key
-        node = hash_ring.get_node(key)
-        next_node = get_next_node(node)  # Get the next node for backup
-        print(node, "---", next_node)
-
-        # Create the original document
-        document = {"_id": key, "value": f"value_{i}"}
-        documents_dict[node].append(document)
-
-        # Create a backup copy of the document (with the same key but `is_backup` set to True)
-        backup_document = {"_id": key, "value": f"value_{i}", "is_backup": True}
-        backup_documents_dict[next_node].append(backup_document)
-
-        # Update key range and count for the node
-        if key_ranges[node]["min"] is None or int(key) < int(key_ranges[node]["min"]):
-            key_ranges[node]["min"] = key
-        if key_ranges[node]["max"] is None or int(key) > int(key_ranges[node]["max"]):
-            key_ranges[node]["max"] = key
-        key_ranges[node]["count"] += 1
-        key_ranges[next_node]["backup_count"] += 1
-
-        # Insert documents in batches
-        if len(documents_dict[node]) == batch_size:
-            mongo_client = mongo_clients[node]
-            db = mongo_client['mydatabase']
-            collection = db['mycollection']
-            await collection.insert_many(documents_dict[node])
-            documents_dict[node] = []
-
-        if len(backup_documents_dict[next_node]) == batch_size:
-            backup_client = mongo_clients[next_node]
-            backup_db = backup_client['mydatabase']
-            backup_collection = backup_db['mycollection']
-            await backup_collection.insert_many(backup_documents_dict[next_node])
-            backup_documents_dict[next_node] = []
+        nodes = preference_list(key, n)
+        node = nodes[0]  # The next distinct nodes clockwise hold the backups
+
+        # Create the original document; quorum_write also stores it in the replica collections of the backup nodes
+        documents.append({"_id": key, "value": f"value_{i}", "ring_hash": ring_hash(key)})
+
+        # Update key range and count for the node; keys are generated in increasing order
+        range_info = key_ranges[node]
+        if range_info["min"] is None:
+            range_info["min"] = i
+        range_info["max"] = i
+        range_info["count"] += 1
+        for backup_node in nodes[1:]:
+            key_ranges[backup_node]["backup_count"] += 1
+
+        # Replicate documents in batches, keeping a bounded number of quorum writes in flight
+        if len(documents) == batch_size:
+            in_flight.append(asyncio.create_task(quorum_write(documents, n, w, writers)))
+            documents = []
+            if len(in_flight) >= max_in_flight:
+                await in_flight.pop(0)
 
     # Insert any remaining documents
-    for node, documents in documents_dict.items():
-        if documents:
-            mongo_client = mongo_clients[node]
-            db = mongo_client['mydatabase']
-            collection = db['mycollection']
-            await collection.insert_many(documents)
-    for node, backup_documents in backup_documents_dict.items():
-        if backup_documents:
-            backup_client = mongo_clients[node]
-            backup_db = backup_client['mydatabase']
-            backup_collection = backup_db['mycollection']
-            await backup_collection.insert_many(backup_documents)
+    if documents:
+        in_flight.append(asyncio.create_task(quorum_write(documents, n, w, writers)))
+    try:
+        await asyncio.gather(*in_flight)
+        # Let replicas that were slower than the quorum finish before the writers stop
+        await asyncio.gather(*list(_replication_tasks))
+    finally:
+        await writers.close()
 
     end_time = time.time()
     elapsed_time = end_time - start_time
     print(f"Inserted {num_docs} documents in {elapsed_time} seconds")
+    writers.report()
 
     # Display key distribution analysis
     print("\nKey Distribution Analysis:")
@@ -99,96 +869,427 @@ async def insert_documents_with_backup(num_docs, start_id=0, batch_size=100000):
         print()
 
 
+# Read-through document cache: bounded LRU with optional TTL, each entry tagged with the node it was read from
+class DocumentCache:
+    def __init__(self, max_entries=100000, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (document, node, expires_at)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Return the cached document if it was read from the node that owns the key now
+    def get(self, key, node):
+        entry = self.entries.get(key)
+        if entry is not None:
+            document, cached_node, expires_at = entry
+            if cached_node == node and (expires_at is None or expires_at > time.monotonic()):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return document
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, node, document):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        self.entries[key] = (document, node, expires_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, keys):
+        for key in keys:
+            self.entries.pop(key, None)
+
+    # Drop every entry read from a node
+    def invalidate_node(self, node):
+        for key in [key for key, entry in self.entries.items() if entry[1] == node]:
+            del self.entries[key]
+
+    # Point entries at the nodes that own their keys after a migration copied the documents there
+    def retag(self, owners):
+        for key, owner in owners.items():
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries[key] = (entry[0], owner, entry[2])
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+# Cache in front of find_document and find_documents
+document_cache = DocumentCache()
+
+
 # Async function to delete all documents from the collection
 async def delete_all_documents():
+    document_cache.clear()
+    hash_trees.clear()
     try:
-        for client in mongo_clients.values():
+        for node_key, client in mongo_clients.items():
             db = client['mydatabase']
-            collection = db['mycollection']
-            result = await collection.delete_many({})
-            print(f"Deleted {result.deleted_count} documents from collection '{collection.name}'")
+            for name in node_collection_names(node_key):
+                result = await db[name].delete_many({})
+                print(f"Deleted {result.deleted_count} documents from collection '{name}' on {node_key}")
+            # Hints left by an earlier run would be replayed into the emptied cluster on the next restore
+            await db['hints'].delete_many({})
+        if os.path.exists(hint_log_path):
+            os.remove(hint_log_path)
     except Exception as e:
         print(f"Error deleting documents: {e}")
 
 
+# Async function to count a node's main and backup documents from collection metadata, without scanning them
+async def count_main_and_backup_data(node_key):
+    db = mongo_clients[node_key]['mydatabase']
+    main_name, *replica_names = node_collection_names(node_key)
+    main_count = await db[main_name].estimated_document_count()
+    backup_count = sum([await db[name].estimated_document_count() for name in replica_names])
+    return main_count, backup_count
+
+
 # Function to identify and display main data and backup data on each node
 async def identify_main_and_backup_data():
-    for node_key, mongo_client in mongo_clients.items():
-        db = mongo_client['mydatabase']
-        collection = db['mycollection']
-        main_count = await collection.count_documents({"is_backup": {"$exists": False}})
-        backup_count = await collection.count_documents({"is_backup": True})
+    for node_key in mongo_clients:
+        main_count, backup_count = await count_main_and_backup_data(node_key)
         print(f"Node: {node_key} -> Main Data: {main_count}, Backup Data: {backup_count}")
 
 
+# Hedged reads: when the primary has not answered within the hedge delay, the same read goes to the next replica
+hedged_reads = False
+hedge_delay = None  # Seconds; None waits for the primary's own p95 read latency once enough reads were seen
+hedge_quantile = 0.95
+hedge_min_samples = 100
+default_hedge_delay = 0.01
+
+
+# Async function to read one key from one node, recording the node's read latency for the hedge delay
+async def read_replica_document(node, key):
+    start_time = time.perf_counter()
+    try:
+        return await client_manager.call(
+            node, lambda client: client['mydatabase'][key_collection_name(node, key)].find_one({"_id": key}))
+    finally:
+        # A read cancelled by a hedge still counts: its latency was at least this long
+        metrics.observe("replica_read", node, time.perf_counter() - start_time)
+
+
+# Function to get how long to wait for a node before hedging a read to the next replica
+def hedge_delay_for(node):
+    if hedge_delay is not None:
+        return hedge_delay
+    histogram = metrics.histograms.get(("replica_read", node))
+    if histogram is None or histogram.count < hedge_min_samples:
+        return default_hedge_delay
+    return histogram.quantile(hedge_quantile)
+
+
+# Async function to read a key from a node, hedging to the next available replica if the node is slow
+async def hedged_find(key, node, tried):
+    """Return (node, document) from whichever replica answered first; raises if every replica asked failed."""
+    start_time = time.perf_counter()
+    primary = asyncio.create_task(read_replica_document(node, key))
+    backup = None
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=hedge_delay_for(node))
+        backup_node = None if done else client_manager.route(key, tried | {node})
+        if backup_node is None:
+            return node, await primary
+
+        metrics.count("hedged_reads", node)
+        backup = asyncio.create_task(read_replica_document(backup_node, key))
+        pending = {primary, backup}
+        while pending:
+            _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            if primary.done() and primary.exception() is None:
+                metrics.observe("hedged_find", node, time.perf_counter() - start_time)
+                return node, primary.result()
+            # The backup may lag the primary, so its "not found" only counts once the primary has failed
+            if backup.done() and backup.exception() is None and (backup.result() is not None or primary.done()):
+                metrics.count("hedge_wins", backup_node)
+                metrics.observe("hedged_find", node, time.perf_counter() - start_time)
+                return backup_node, backup.result()
+        raise primary.exception()
+    finally:
+        for task in (primary, backup):
+            if task is not None and not task.done():
+                task.cancel()
+            elif task is not None and not task.cancelled():
+                task.exception()  # Mark a losing failure as seen
+
+
 async def find_document(key):
-    node = hash_ring.get_node(key)
-    mongo_client = mongo_clients.get(node)
+    start_time = time.perf_counter()
+    owner = hash_ring.get_node(key)
+    if read_quorum > 1:
+        # R answers are needed, so the read goes to the replicas instead of the cache or a single node
+        document = await quorum_read(key)
+        metrics.observe("find", owner, time.perf_counter() - start_time)
+        return document
+    node = owner
+    tried = set()
+    document = None
 
-    if not mongo_client:
-        # If the node is down, get the backup node
-        print(f"Node {node} is down, using backup data.")
-        node = get_next_node(node)  # Redirect to the backup node
-        mongo_client = mongo_clients[node]
+    # Nodes that are down or whose breaker is open are skipped straight away, in ring order
+    while True:
+        node = client_manager.route(key, tried)
+        if node is None:
+            node = owner
+            break
+        if node != owner and not tried:
+            metrics.count("backup_reads", owner)  # The owner is down or its circuit is open
+        document = document_cache.get(key, node)
+        if document is not None:
+            break
+        try:
+            if hedged_reads:
+                node, document = await hedged_find(key, node, tried)
+            else:
+                document = await read_replica_document(node, key)
+        except Exception as e:
+            print(f"Error reading key '{key}' from {node}: {e}")
+            metrics.count("read_failovers", node)
+            tried.add(node)
+            continue
+        if document:
+            document_cache.put(key, node, document)
+        break
+    metrics.observe("find", node, time.perf_counter() - start_time)
+    return document
 
-    print(f"Querying key '{key}' on node '{node}'")
-    db = mongo_client['mydatabase']
-    collection = db['mycollection']
 
-    # Attempt to find the document
-    document = await collection.find_one({"_id": key})
-    if not document:
-        print(f"Document with key '{key}' not found")
-    else:
-        print(document)
+# Async function to find many documents at once with one $in query per node, using backups for downed owners
+async def find_documents(keys):
+    """Return the documents for keys in input order, with None for keys that were not found."""
+    if read_quorum > 1:
+        return list(await asyncio.gather(*(quorum_read(key) for key in keys)))
+    found = {}
+    grouped_keys = {}
+    for key in keys:
+        node = client_manager.route(key)
+        if node is None:
+            continue
+        document = document_cache.get(key, node)
+        if document is not None:
+            found[key] = document
+        else:
+            grouped_keys.setdefault(node, []).append(key)
+
+    # Async function to run one $in query per collection the keys live in on a node; an owner needs only one
+    async def find_in_collections(node, client, node_keys):
+        grouped_keys = group_keys_by_collection(node, node_keys)
+        if len(grouped_keys) == 1:
+            name, name_keys = grouped_keys.popitem()
+            return await client['mydatabase'][name].find({"_id": {"$in": name_keys}}).to_list(None)
+        found = await asyncio.gather(*(client['mydatabase'][name].find({"_id": {"$in": name_keys}}).to_list(None)
+                                       for name, name_keys in grouped_keys.items()))
+        return [document for documents in found for document in documents]
+
+    async def find_on_node(node, node_keys, tried=frozenset()):
+        start_time = time.perf_counter()
+        try:
+            documents = await client_manager.call(node, lambda client: find_in_collections(node, client, node_keys))
+        except Exception as e:
+            # Ask the next available replica of each key instead
+            print(f"Error reading {len(node_keys)} keys from {node}: {e}")
+            metrics.count("read_failovers", node)
+            tried = tried | {node}
+            retry_keys = {}
+            for key in node_keys:
+                fallback = client_manager.route(key, tried)
+                if fallback is not None:
+                    retry_keys.setdefault(fallback, []).append(key)
+            retried = await asyncio.gather(*(find_on_node(fallback, fallback_keys, tried)
+                                             for fallback, fallback_keys in retry_keys.items()))
+            return [document for documents in retried for document in documents]
+        metrics.observe("find_many", node, time.perf_counter() - start_time)
+        for document in documents:
+            document_cache.put(document["_id"], node, document)
+        return documents
+
+    for documents in await asyncio.gather(*(find_on_node(node, node_keys) for node, node_keys in grouped_keys.items())):
+        found.update((document["_id"], document) for document in documents)
+    return [found.get(key) for key in keys]
+
 
 # Function to simulate taking down a node
 def take_down_node(node_key):
     print(f"\nTaking down node: {node_key}")
-    hash_ring.remove_node(node_key)
+    # The node keeps its place on the ring: reads fall back to backups and writes meant for it become hints
     mongo_clients.pop(node_key, None)
+    hinted_nodes.add(node_key)
+    document_cache.invalidate_node(node_key)
+
+
+# Async function to hand a cursor to a coroutine in batches, with at most max_concurrency batches in flight;
+# the first failed batch stops the stream, and its error is raised once the batches in flight have finished
+async def for_each_batch(cursor, batch_size, handle_batch, max_concurrency=4):
+    semaphore = asyncio.Semaphore(max_concurrency)
+    tasks = []
+    errors = []
+
+    async def run(batch):
+        try:
+            await handle_batch(batch)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            semaphore.release()
+
+    async def launch(batch):
+        await semaphore.acquire()
+        if errors:
+            return False
+        tasks[:] = [task for task in tasks if not task.done()]
+        tasks.append(asyncio.create_task(run(batch)))
+        return True
+
+    batch = []
+    async for document in cursor:
+        batch.append(document)
+        if len(batch) == batch_size:
+            if not await launch(batch):
+                break
+            batch = []
+    else:
+        if batch:
+            await launch(batch)
+    await asyncio.gather(*tasks)
+    if errors:
+        raise errors[0]
+
+
+# Async function to find which of the given keys a collection is missing
+async def find_missing_keys(collection, keys):
+    existing = {document["_id"] async for document in collection.find({"_id": {"$in": keys}}, {"_id": 1})}
+    return [key for key in keys if key not in existing]
+
+
+# Function to read a raw BSON document's _id without decoding the rest; MongoDB stores _id as the first field
+def raw_id(document):
+    raw = document.raw
+    element = raw[4:9]
+    if element == b"\x02_id\x00":  # String
+        return raw[13:12 + int.from_bytes(raw[9:13], "little")].decode("utf-8")
+    if element == b"\x10_id\x00":  # 32-bit integer
+        return int.from_bytes(raw[9:13], "little", signed=True)
+    if element == b"\x12_id\x00":  # 64-bit integer
+        return int.from_bytes(raw[9:17], "little", signed=True)
+    if element == b"\x07_id\x00":
+        return bson.ObjectId(raw[9:21])
+    return document["_id"]
+
+
+# Function to drop cached backup copies of keys that a restored node owns again
+def invalidate_backup_reads(node_key):
+    document_cache.invalidate([key for key, entry in document_cache.entries.items()
+                               if entry[1] != node_key and preference_list(key, 2)[0] == node_key])
 
 
 # Function to restore a node and sync data
-async def restore_node_and_sync(node_key):
+async def restore_node_and_sync(node_key, batch_size=10000, max_concurrency=4, full_sync=None):
     print(f"Restoring node: {node_key}")
     hash_ring.add_node(node_key)
-    mongo_clients[node_key] = AsyncIOMotorClient(node_key.split(":")[0], int(node_key.split(":")[1]))
+    # The manager kept the node's client and its pool while the node was out of service
+    mongo_clients[node_key] = client_manager.client(node_key)
+    client_manager.record_success(node_key)
+
+    # A node taken down by take_down_node only missed the writes kept as hints since then
+    if full_sync is None:
+        full_sync = node_key not in hinted_nodes
+    hinted_nodes.discard(node_key)
+    if not full_sync:
+        start_time = time.time()
+        replayed_count = await replay_hints(node_key, batch_size)
+        invalidate_backup_reads(node_key)
+        elapsed_time = time.time() - start_time
+        metrics.observe("restore", node_key, elapsed_time)
+        print(f"Restored node {node_key} in {elapsed_time} seconds from {replayed_count} hints")
+        return
 
-    # Get the next node in the hash ring for backup data
-    next_node = get_next_node(node_key)
     mongo_client = mongo_clients[node_key]
     db = mongo_client['mydatabase']
     collection = db['mycollection']
+    # Copies move as raw BSON between primary and replica collections; only _id is parsed
+    raw_collection = collection.with_options(codec_options=DEFAULT_RAW_BSON_OPTIONS)
+
+    start_time = time.time()
+    progress = {"scanned": 0, "repaired": 0}
+
+    def report_progress(stage):
+        elapsed_time = max(time.time() - start_time, 1e-9)
+        print(f"{stage}: scanned {progress['scanned']} keys, repaired {progress['repaired']} "
+              f"({progress['scanned'] / elapsed_time:.0f} keys/sec)")
+
+    # Sync missing data to the restored node from the backups held by its ring successors; each successor keeps them
+    # in one replica collection, so the whole collection is streamed without filtering
+    for backup_node, backup_client in mongo_clients.items():
+        if backup_node == node_key:
+            continue
+        backup_collection = backup_client['mydatabase'][collection_name(backup_node, node_key)].with_options(
+            codec_options=DEFAULT_RAW_BSON_OPTIONS)
 
-    # Get the backup client and collection
-    backup_client = mongo_clients[next_node]
-    backup_db = backup_client['mydatabase']
-    backup_collection = backup_db['mycollection']
+        async def sync_batch(backup_ids, backup_node=backup_node, backup_collection=backup_collection):
+            missing_keys = await find_missing_keys(collection, [raw_id(document) for document in backup_ids])
+            if missing_keys:
+                # Copy the missing documents from backup to the restored node
+                batch_start = time.perf_counter()
+                original_documents = await backup_collection.find({"_id": {"$in": missing_keys}}).to_list(None)
+                await collection.insert_many(original_documents, ordered=False)
+                metrics.observe("restore_batch", node_key, time.perf_counter() - batch_start)
+                metrics.count("documents_restored", node_key, len(original_documents))
+                metrics.count("bytes_restored", node_key, sum(len(doc.raw) for doc in original_documents))
+                progress["repaired"] += len(original_documents)
+            progress["scanned"] += len(backup_ids)
+            report_progress(f"Syncing from {backup_node}")
 
-    # Sync missing data from backup to the restored node
-    backup_documents = backup_collection.find({"is_backup": True})
-    async for document in backup_documents:
-        original_key = document["_id"]
-        if await collection.count_documents({"_id": original_key}) == 0:
-            # Copy the missing document from backup to the restored node
-            original_document = {"_id": original_key, "value": document["value"]}
-            await collection.insert_one(original_document)
+        await for_each_batch(backup_collection.find({}, {"_id": 1}), batch_size, sync_batch, max_concurrency)
 
     print(f"Data synced to restored node: {node_key}")
+    invalidate_backup_reads(node_key)
+
+    # Re-create backup copies on every other replica of each key
+    async def backup_batch(documents):
+        grouped_documents = {}
+        for document in documents:
+            key = raw_id(document)
+            for next_node in preference_list(key, replication_factor)[1:]:
+                if next_node in mongo_clients:
+                    grouped_documents.setdefault(next_node, []).append((key, document))
+
+        async def repair_backups(next_node, node_documents):
+            backup_collection = mongo_clients[next_node]['mydatabase'][collection_name(next_node, node_key)]
+            missing_keys = set(await find_missing_keys(backup_collection, [key for key, _ in node_documents]))
+            if missing_keys:
+                backup_documents = [document for key, document in node_documents if key in missing_keys]
+                await backup_collection.insert_many(backup_documents, ordered=False)
+                record_written(next_node, backup_documents)  # Digests decode only the repaired copies
+                metrics.count("backups_recreated", next_node, len(backup_documents))
+                metrics.count("bytes_restored", next_node, sum(len(doc.raw) for doc in backup_documents))
+                progress["repaired"] += len(backup_documents)
+
+        await asyncio.gather(*(repair_backups(next_node, node_documents)
+                               for next_node, node_documents in grouped_documents.items()))
+        progress["scanned"] += len(documents)
+        report_progress("Re-creating backups")
 
-    # Re-create backup copies on the next node
-    documents = collection.find({"is_backup": {"$exists": False}})
-    backup_documents_to_insert = []
-    async for document in documents:
-        backup_key = document["_id"]
-        if await backup_collection.count_documents({"_id": backup_key}) == 0:
-            backup_document = {"_id": backup_key, "value": document["value"], "is_backup": True}
-            backup_documents_to_insert.append(backup_document)
+    await for_each_batch(raw_collection.find({}), batch_size, backup_batch, max_concurrency)
 
-    if backup_documents_to_insert:
-        await backup_collection.insert_many(backup_documents_to_insert)
-        print(f"Backup data re-created on node: {next_node}")
+    # The restored node's data is whatever survived plus the repairs, so its hash trees are rebuilt from it
+    await rebuild_hash_trees(node_key, batch_size)
+
+    elapsed_time = time.time() - start_time
+    metrics.observe("restore", node_key, elapsed_time)
+    print(f"Restored node {node_key} in {elapsed_time} seconds: scanned {progress['scanned']} keys, "
+          f"repaired {progress['repaired']}")
 
 
 # Function to check data consistency
@@ -197,11 +1298,8 @@ async def check_data_consistency():
     total_backup_data = 0
 
     print("\nData Distribution:")
-    for node_key, mongo_client in mongo_clients.items():
-        db = mongo_client['mydatabase']
-        collection = db['mycollection']
-        main_data_count = await collection.count_documents({"is_backup": {"$exists": False}})
-        backup_data_count = await collection.count_documents({"is_backup": True})
+    for node_key in mongo_clients:
+        main_data_count, backup_data_count = await count_main_and_backup_data(node_key)
         total_main_data += main_data_count
         total_backup_data += backup_data_count
         print(f"Node: {node_key} -> Main Data: {main_data_count}, Backup Data: {backup_data_count}")
@@ -209,10 +1307,84 @@ async def check_data_consistency():
     print(f"\nTotal Main Data: {total_main_data}, Total Backup Data: {total_backup_data}")
 
 
+# Async function to copy a batch of backups a node holds in one collection to the replica collections of every node
+# in each key's preference list, returning the keys the node should not keep in that collection
+async def place_backups(node_key, name, documents):
+    grouped_documents = {}
+    misplaced_keys = []
+    for document in documents:
+        document.pop("is_backup", None)
+        document["ring_hash"] = ring_hash(document["_id"])
+        nodes = preference_list(document["_id"], replication_factor)
+        for replica in nodes[1:]:
+            if replica in mongo_clients:
+                grouped_documents.setdefault((replica, collection_name(replica, nodes[0])), []).append(document)
+        if node_key not in nodes[1:] or name != collection_name(node_key, nodes[0]):
+            misplaced_keys.append(document["_id"])
+
+    # Replacing keeps a rerun idempotent and adds ring_hash to copies that were already in place
+    for (replica, replica_name), replica_documents in grouped_documents.items():
+        await mongo_clients[replica]['mydatabase'][replica_name].bulk_write(
+            [ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in replica_documents], ordered=False)
+    return misplaced_keys
+
+
+# Async function to move backups of the old layout, flagged with is_backup in "mycollection", into replica collections
+async def migrate_to_replica_collections(batch_size=10000):
+    """One-time conversion; it can be stopped and rerun, and returns the number of backup copies moved."""
+    for node_key, client in mongo_clients.items():
+        if await client['mydatabase']['hints'].estimated_document_count():
+            print(f"Node {node_key} still keeps hints; restore the nodes they are for before migrating")
+            return 0
+    if os.path.exists(hint_log_path) and os.path.getsize(hint_log_path):
+        print(f"{hint_log_path} still holds hints; restore the nodes they are for before migrating")
+        return 0
+
+    await ensure_indexes()
+    moved_count = 0
+    for node_key, client in mongo_clients.items():
+        start_time = time.time()
+        node_moved_count = 0
+        # The old layout put each backup on the node after the primary in list(hash_ring.nodes), not on the key's
+        # ring successor, so every backup is re-filed under its preference list; copies left in replica collections
+        # by an interrupted run are checked the same way
+        sources = [("mycollection", {"is_backup": True})] + [(name, {}) for name in node_collection_names(node_key)[1:]]
+        for name, query in sources:
+            collection = client['mydatabase'][name]
+            documents = []
+            async for document in collection.find(query):
+                documents.append(document)
+                if len(documents) < batch_size:
+                    continue
+                misplaced_keys = await place_backups(node_key, name, documents)
+                await collection.delete_many({"_id": {"$in": misplaced_keys}, **query})
+                node_moved_count += len(misplaced_keys)
+                documents = []
+            if documents:
+                misplaced_keys = await place_backups(node_key, name, documents)
+                await collection.delete_many({"_id": {"$in": misplaced_keys}, **query})
+                node_moved_count += len(misplaced_keys)
+            print(f"Moved {node_moved_count} backups on {node_key} into replica collections")
+        moved_count += node_moved_count
+        print(f"{node_key}: moved {node_moved_count} backups in {time.time() - start_time} seconds")
+
+    # Rebuilding the trees also adds ring_hash to the primaries, which the old layout stored without it; anti-entropy
+    # then re-creates the backups that were lost or could not be stored before
+    for node_key in mongo_clients:
+        await rebuild_hash_trees(node_key, batch_size)
+    await anti_entropy()
+    return moved_count
+
+
 # Example usage
 async def main():
+    # Open connections to every node before the first request, then keep checking their health
+    await client_manager.warm_up()
+    client_manager.start_health_checks()
+
     # Clean up any previous data
     await delete_all_documents()
+    await ensure_indexes()
 
     num_documents = 100  # Adjust as needed
     # Insert documents with backup
@@ -222,24 +1394,38 @@ async def main():
     await identify_main_and_backup_data()
 
     # Step 1: Query data from nodes
-    await find_document("13")
-    await find_document("25")
-    await find_document("99")
+    print(f"Key: 13 -> {await find_document('13') or 'not found'}")
+    print(f"Key: 25 -> {await find_document('25') or 'not found'}")
+    print(f"Key: 99 -> {await find_document('99') or 'not found'}")
 
     # Step 2: Take down a node
     take_down_node("localhost:27020")
 
     # Step 3: Query data again, should use backup copies
-    await find_document("13")
-    await find_document("25")
-    await find_document("99")
+    print(f"Key: 13 -> {await find_document('13') or 'not found'}")
+    print(f"Key: 25 -> {await find_document('25') or 'not found'}")
+    print(f"Key: 99 -> {await find_document('99') or 'not found'}")
+
+    # Step 4: Keep writing while the node is down; its share is kept as hints
+    await insert_documents_with_backup(10, start_id=num_documents)
 
     # Step 5: Restore the node and sync data
     await restore_node_and_sync("localhost:27020")
 
-    await find_document("13")
-    await find_document("25")
-    await find_document("99")
+    print(f"Key: 13 -> {await find_document('13') or 'not found'}")
+    print(f"Key: 25 -> {await find_document('25') or 'not found'}")
+    print(f"Key: 99 -> {await find_document('99') or 'not found'}")
+
+    # Repair any ranges where primaries and backups diverged
+    await anti_entropy()
+
+    # Find several documents in one round trip per node
+    example_keys = ["13", "25", "99", "not-a-key"]
+    for key, document in zip(example_keys, await find_documents(example_keys)):
+        print(f"Key: {key} -> {document if document else 'not found'}")
+    print(f"Document cache: {document_cache.stats()}")
+    await client_manager.stop_health_checks()
+    metrics.report()
 
 
 if __name__ == "__main__":
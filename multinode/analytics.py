@@ -0,0 +1,157 @@
+import base64
+import json
+import numpy as np
+
+# HyperLogLog precision: 2 ** 12 one-byte registers per node, about 1.6% standard error
+hll_precision = 12
+
+# Ring positions are summarized in 2 ** 12 equal buckets, so quantiles are exact to 1/4096 of the ring
+position_bits = 12
+
+
+# Function to get the bit length of every value in a uint64 array
+def bit_length(values):
+    values = values.copy()
+    lengths = np.zeros(len(values), dtype=np.uint8)
+    for shift in (32, 16, 8, 4, 2, 1):
+        wide = values >= np.uint64(1 << shift)
+        lengths[wide] += shift
+        values[wide] >>= np.uint64(shift)
+    return lengths + (values > 0)
+
+
+# Mergeable summary of the keys routed to one node: count, key range, HyperLogLog, ring-position histogram, vnode loads
+class NodeSummary:
+    def __init__(self):
+        self.count = 0
+        self.min_key = None
+        self.max_key = None
+        self.registers = np.zeros(1 << hll_precision, dtype=np.uint8)
+        self.positions = np.zeros(1 << position_bits, dtype=np.int64)
+        self.vnodes = {}
+
+    # Function to add a batch of hash_many results, with optional numeric ids and the ring vnode each key landed on
+    def add(self, hashes, ids=None, vnode_indices=None, vnode_keys=None):
+        if not len(hashes):
+            return
+        self.count += len(hashes)
+        if ids is not None:
+            low, high = int(ids.min()), int(ids.max())
+            self.min_key = low if self.min_key is None else min(self.min_key, low)
+            self.max_key = high if self.max_key is None else max(self.max_key, high)
+
+        # The high half is the ring position, so the independent low half feeds the cardinality sketch
+        low_bits = hashes[:, 1]
+        registers = (low_bits >> np.uint64(64 - hll_precision)).astype(np.intp)
+        remaining = low_bits & np.uint64((1 << (64 - hll_precision)) - 1)
+        ranks = (64 - hll_precision + 1 - bit_length(remaining)).astype(np.uint8)
+        np.maximum.at(self.registers, registers, ranks)
+
+        self.positions += np.bincount((hashes[:, 0] >> np.uint64(64 - position_bits)).astype(np.intp),
+                                      minlength=len(self.positions))
+        if vnode_indices is not None:
+            counts = np.bincount(vnode_indices, minlength=len(vnode_keys))
+            for index in np.nonzero(counts)[0].tolist():
+                self.vnodes[vnode_keys[index]] = self.vnodes.get(vnode_keys[index], 0) + int(counts[index])
+
+    def merge(self, other):
+        self.count += other.count
+        for name, pick in (("min_key", min), ("max_key", max)):
+            values = [value for value in (getattr(self, name), getattr(other, name)) if value is not None]
+            setattr(self, name, pick(values) if values else None)
+        np.maximum(self.registers, other.registers, out=self.registers)
+        self.positions += other.positions
+        for vnode, count in other.vnodes.items():
+            self.vnodes[vnode] = self.vnodes.get(vnode, 0) + count
+        return self
+
+    # Function to estimate the number of distinct keys (HyperLogLog with linear counting for small sets)
+    def cardinality(self):
+        registers = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / registers)
+        estimate = alpha * registers * registers / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        empty = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * registers and empty:
+            estimate = registers * np.log(registers / empty)
+        return int(round(estimate))
+
+    # Function to get the ring position, as a fraction of the ring, below which a given fraction of the keys fall
+    def position_quantile(self, fraction):
+        if not self.count:
+            return None
+        bucket = int(np.searchsorted(np.cumsum(self.positions), fraction * self.count))
+        return min(bucket + 1, len(self.positions)) / len(self.positions)
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "min_key": self.min_key,
+            "max_key": self.max_key,
+            "registers": base64.b64encode(self.registers.tobytes()).decode("ascii"),
+            "positions": {str(bucket): int(self.positions[bucket]) for bucket in np.nonzero(self.positions)[0]},
+            "vnodes": {f"{vnode:x}": count for vnode, count in self.vnodes.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        summary = cls()
+        summary.count = data["count"]
+        summary.min_key = data["min_key"]
+        summary.max_key = data["max_key"]
+        summary.registers = np.frombuffer(base64.b64decode(data["registers"]), dtype=np.uint8).copy()
+        for bucket, count in data["positions"].items():
+            summary.positions[int(bucket)] = count
+        summary.vnodes = {int(vnode, 16): count for vnode, count in data["vnodes"].items()}
+        return summary
+
+
+# Per-node summaries of a key stream; partial results from separate workers merge into one
+class KeyDistribution:
+    def __init__(self):
+        self.nodes = {}
+
+    def summary(self, node):
+        if node not in self.nodes:
+            self.nodes[node] = NodeSummary()
+        return self.nodes[node]
+
+    def merge(self, other):
+        for node, summary in other.nodes.items():
+            self.summary(node).merge(summary)
+        return self
+
+    def to_dict(self):
+        return {node: summary.to_dict() for node, summary in self.nodes.items()}
+
+    @classmethod
+    def from_dict(cls, data):
+        distribution = cls()
+        distribution.nodes = {node: NodeSummary.from_dict(summary) for node, summary in data.items()}
+        return distribution
+
+    def export(self, path):
+        with open(path, "w") as output:
+            json.dump(self.to_dict(), output)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as data:
+            return cls.from_dict(json.load(data))
+
+    def report(self):
+        total = sum(summary.count for summary in self.nodes.values())
+        for node, summary in sorted(self.nodes.items()):
+            print(f"Node: {node}")
+            print(f"  Min Key: {summary.min_key}")
+            print(f"  Max Key: {summary.max_key}")
+            print(f"  Total Keys: {summary.count} ({summary.count / total:.1%} of all keys)" if total else
+                  "  Total Keys: 0")
+            print(f"  Distinct Keys (approx.): {summary.cardinality()}")
+            if summary.count:
+                print(f"  Ring Position p1/p50/p99: {summary.position_quantile(0.01):.4f} / "
+                      f"{summary.position_quantile(0.5):.4f} / {summary.position_quantile(0.99):.4f}")
+            if summary.vnodes:
+                loads = np.array(list(summary.vnodes.values()))
+                print(f"  Vnode Load: {len(loads)} vnodes, min {loads.min()}, mean {loads.mean():.0f}, "
+                      f"max {loads.max()}")
+            print()
@@ -0,0 +1,33 @@
+"""Stream records from a JSONL or CSV file onto the hash ring nodes, resumable from a byte offset."""
+import argparse
+import asyncio
+import sys
+
+import hash_ring_mongodb_insert_and_find as ring
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("path", help="JSONL (one object per line) or CSV (header row first) file")
+    parser.add_argument("--format", choices=["jsonl", "csv"], help="record format; guessed from the extension")
+    parser.add_argument("--key-field", default="_id", help="field routed on and stored, as a string, in _id")
+    parser.add_argument("--batch-size", type=int, default=10000, help="documents per insert_many")
+    parser.add_argument("--max-in-flight", type=int, default=2, help="concurrent inserts per node")
+    parser.add_argument("--queue-size", type=int, default=4, help="batches queued per node before reading pauses")
+    parser.add_argument("--checkpoint", help="file recording the committed byte offset (default: PATH.offset)")
+    parser.add_argument("--checkpoint-every", type=int, default=100000, help="rows between checkpoints")
+    parser.add_argument("--resume", action="store_true", help="start from the offset in the checkpoint file")
+    parser.add_argument("--start-offset", type=int, help="start from this byte offset, which must begin a record")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    asyncio.run(ring.bulk_load(options.path, options.format, options.key_field, options.batch_size,
+                               options.max_in_flight, options.queue_size, options.checkpoint,
+                               options.checkpoint_every, options.resume, options.start_offset))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,25 @@
 import asyncio
+import copy
+import heapq
+import itertools
+import json
+import math
+import os
+from bisect import bisect, bisect_left
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import md5
+import bson
+from bson.raw_bson import DEFAULT_RAW_BSON_OPTIONS
+import numpy as np
 from uhashring import HashRing
 from motor.motor_asyncio import AsyncIOMotorClient
+from analytics import KeyDistribution
+from placement import placement_engines
+from record_files import detect_format, read_load_checkpoint, read_records, save_load_checkpoint
+from ring_state import RingSnapshot, read_epoch
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 import time
 
 
@@ -11,70 +30,656 @@ mongodb_nodes = [
     {"host": "localhost", "port": 27021}
 ]
 
-# Initialize HashRing with MongoDB nodes
-hash_ring = HashRing(nodes=[f"{node['host']}:{node['port']}" for node in mongodb_nodes])
+# Placement engine deciding which node owns a key: "ketama" (uhashring vnodes), "jump", "rendezvous" or "maglev"
+placement_engine = "ketama"
+
+
+# Function to create the configured placement engine for a list of node keys
+def create_placement(node_keys):
+    return placement_engines[placement_engine](nodes=node_keys)
+
+
+# Initialize HashRing with MongoDB nodes; a saved ring snapshot replaces it further down
+hash_ring = create_placement([f"{node['host']}:{node['port']}" for node in mongodb_nodes])
+
+# Ring snapshot shared by every router process, and the membership epoch this process routes with
+ring_state_path = "ring.snapshot"
+ring_epoch = 0
+
+
+# Function to connect to a storage node; swap it for another backend returning a Motor-compatible client
+def create_client(host, port):
+    return AsyncIOMotorClient(host, port)
+
 
 # Initialize MongoDB clients asynchronously
 mongo_clients = {
-    f"{node['host']}:{node['port']}": AsyncIOMotorClient(node["host"], node["port"]) for node in mongodb_nodes
+    f"{node['host']}:{node['port']}": create_client(node["host"], node["port"]) for node in mongodb_nodes
 }
 
 
+# Latency histogram with log-linear buckets (16 per power of two, about 6% wide): recording is one frexp and a dict update
+class LatencyHistogram:
+    sub_buckets = 16
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        mantissa, exponent = math.frexp(max(seconds, 1e-9))
+        bucket = exponent * self.sub_buckets + int((mantissa - 0.5) * 2 * self.sub_buckets)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def upper_bound(self, bucket):
+        exponent, sub_bucket = divmod(bucket, self.sub_buckets)
+        return math.ldexp(0.5 + (sub_bucket + 1) / (2 * self.sub_buckets), exponent)
+
+    def quantile(self, fraction):
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= fraction * self.count:
+                return min(self.upper_bound(bucket), self.max)
+        return self.max
+
+
+# Counters, gauges and latency histograms keyed by (name, node), exported as Prometheus text or JSON
+class Metrics:
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def count(self, name, node="", value=1):
+        self.counters[(name, node)] = self.counters.get((name, node), 0) + value
+
+    def gauge(self, name, node, value):
+        self.gauges[(name, node)] = value
+
+    def observe(self, name, node, seconds):
+        histogram = self.histograms.get((name, node))
+        if histogram is None:
+            histogram = self.histograms[(name, node)] = LatencyHistogram()
+        histogram.record(seconds)
+
+    def clear(self):
+        self.counters.clear()
+        self.gauges.clear()
+        self.histograms.clear()
+
+    def snapshot(self):
+        return {
+            "counters": [{"name": name, "node": node, "value": value}
+                         for (name, node), value in sorted(self.counters.items())],
+            "gauges": [{"name": name, "node": node, "value": value}
+                       for (name, node), value in sorted(self.gauges.items())],
+            "histograms": [{"name": name, "node": node, "count": histogram.count, "sum": histogram.sum,
+                            "max": histogram.max, "p50": histogram.quantile(0.5), "p90": histogram.quantile(0.9),
+                            "p99": histogram.quantile(0.99)}
+                           for (name, node), histogram in sorted(self.histograms.items())],
+        }
+
+    def export(self, format="prometheus"):
+        if format == "json":
+            return json.dumps(self.snapshot(), indent=2)
+
+        def labels(node, **extra):
+            pairs = ([("node", node)] if node else []) + list(extra.items())
+            return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}" if pairs else ""
+
+        lines = []
+        for kind, suffix, values in (("counter", "_total", self.counters), ("gauge", "", self.gauges)):
+            for name in sorted({name for name, _ in values}):
+                lines.append(f"# TYPE ring_{name}{suffix} {kind}")
+                lines.extend(f"ring_{name}{suffix}{labels(node)} {value}"
+                             for (metric, node), value in sorted(values.items()) if metric == name)
+        for name in sorted({name for name, _ in self.histograms}):
+            lines.append(f"# TYPE ring_{name}_seconds histogram")
+            for (metric, node), histogram in sorted(self.histograms.items()):
+                if metric != name:
+                    continue
+                seen = 0
+                for bucket in sorted(histogram.counts):
+                    seen += histogram.counts[bucket]
+                    lines.append(f"ring_{name}_seconds_bucket{labels(node, le=f'{histogram.upper_bound(bucket):.6g}')} {seen}")
+                lines.append(f"ring_{name}_seconds_bucket{labels(node, le='+Inf')} {histogram.count}")
+                lines.append(f"ring_{name}_seconds_sum{labels(node)} {histogram.sum}")
+                lines.append(f"ring_{name}_seconds_count{labels(node)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def report(self):
+        print("\nOperation Latency:")
+        for (name, node), histogram in sorted(self.histograms.items()):
+            print(f"{name}{' ' + node if node else ''}: {histogram.count} ops, p50 {histogram.quantile(0.5) * 1000:.2f} ms, "
+                  f"p99 {histogram.quantile(0.99) * 1000:.2f} ms, max {histogram.max * 1000:.2f} ms")
+
+
+# Metrics for every node and operation in this process
+metrics = Metrics()
+
+# Number of keys hashed and routed together by route_many
+routing_chunk_size = 65536
+
+# Array view of the ring, rebuilt whenever uhashring replaces its sorted key list
+_ring_arrays = {"keys": None, "nodes": [], "high": None, "owners": None}
+
+
+# Function to hash a batch of keys into the (high, low) 64-bit halves of their uhashring position
+def hash_many(keys):
+    digests = b"".join(md5(str(key).encode("utf-8")).digest() for key in keys)
+    return np.frombuffer(digests, dtype=">u8").reshape(-1, 2)
+
+
+# Function to get the array view of the ring, refreshing it after a membership change
+def get_ring_arrays():
+    ring_keys = hash_ring._keys
+    if _ring_arrays["keys"] is not ring_keys:
+        nodes = list(hash_ring.get_nodes())
+        node_index = {node: index for index, node in enumerate(nodes)}
+        _ring_arrays["keys"] = ring_keys
+        _ring_arrays["nodes"] = nodes
+        _ring_arrays["high"] = np.array([hash_key >> 64 for hash_key in ring_keys], dtype=np.uint64)
+        _ring_arrays["owners"] = np.array([node_index[hash_ring.ring[hash_key]] for hash_key in ring_keys],
+                                          dtype=np.intp)
+    return _ring_arrays
+
+
+# Function to get the node names that route_many indices refer to
+def ring_nodes():
+    if not isinstance(hash_ring, HashRing):
+        return hash_ring.nodes
+    return get_ring_arrays()["nodes"]
+
+
+# Function to route a batch of keys to ring nodes with one sorted search
+def route_many(keys):
+    """Return, for every key, the index in ring_nodes() of the node holding it, honouring bounded-load overflows."""
+    node_indices = route_hashes(hash_many(keys))
+    metrics.count("keys_routed", value=len(keys))
+    if overflow_placements:
+        node_index = {node: index for index, node in enumerate(ring_nodes())}
+        for i, key in enumerate(keys):
+            node = overflow_placements.get(key)
+            if node is not None:
+                node_indices[i] = node_index[node]
+    return node_indices
+
+
+# Function to route a batch of hash_many results to ring nodes
+def route_hashes(hashes):
+    if not isinstance(hash_ring, HashRing):
+        return hash_ring.route_hashes(hashes[:, 0])
+    return get_ring_arrays()["owners"][ring_positions(hashes)]
+
+
+# Function to find the index of the vnode, in the ring arrays, that each hash_many result lands on
+def ring_positions(hashes):
+    ring = get_ring_arrays()
+    ring_keys = ring["keys"]
+    if not ring_keys:
+        raise ValueError("The hash ring has no nodes")
+
+    high = hashes[:, 0]
+    positions = np.searchsorted(ring["high"], high, side="right")
+
+    # Keys sharing their high 64 bits with a vnode need the full 128-bit comparison
+    ties = np.nonzero(np.searchsorted(ring["high"], high, side="left") != positions)[0]
+    for i in ties:
+        positions[i] = bisect(ring_keys, (int(hashes[i, 0]) << 64) | int(hashes[i, 1]))
+
+    positions[positions == len(ring_keys)] = 0
+    return positions
+
+
+# Function to add a routed chunk of keys to a KeyDistribution, with per-vnode loads on the ketama ring
+def summarize_chunk(distribution, hashes, node_indices, ids=None):
+    positions = ring_positions(hashes) if isinstance(hash_ring, HashRing) else None
+    for node_index, node in enumerate(ring_nodes()):
+        node_positions = np.nonzero(node_indices == node_index)[0]
+        if not len(node_positions):
+            continue
+        vnode_indices = vnode_keys = None
+        if positions is not None:
+            ring = get_ring_arrays()
+            vnode_indices, vnode_keys = positions[node_positions], ring["keys"]
+            # Keys moved off a full node by bounded loads don't count toward another node's vnodes
+            vnode_indices = vnode_indices[ring["owners"][vnode_indices] == node_index]
+        distribution.summary(node).add(hashes[node_positions], None if ids is None else ids[node_positions],
+                                       vnode_indices, vnode_keys)
+
+
+# Function to get the ring position of a key as the fixed-width hex string stored in "ring_hash"
+def ring_hash(key):
+    # uhashring positions are the md5 digest read as an integer, so hex order matches ring order
+    return md5(str(key).encode("utf-8")).hexdigest()
+
+
+# Async function to index the stored ring position on every node
+async def ensure_ring_hash_index(clients=None):
+    for client in (clients or mongo_clients).values():
+        await client['mydatabase']['mycollection'].create_index("ring_hash")
+
+
+# Async function to add the ring position to documents inserted before it was stored
+async def backfill_ring_hash(batch_size=10000):
+    for node_key, mongo_client in mongo_clients.items():
+        collection = mongo_client['mydatabase']['mycollection']
+        updates = []
+        async for document in collection.find({"ring_hash": {"$exists": False}}, {"_id": 1}):
+            updates.append(UpdateOne({"_id": document["_id"]}, {"$set": {"ring_hash": ring_hash(document["_id"])}}))
+            if len(updates) == batch_size:
+                await collection.bulk_write(updates, ordered=False)
+                updates = []
+        if updates:
+            await collection.bulk_write(updates, ordered=False)
+        print(f"Backfilled ring_hash on node: {node_key}")
+
+
+# Per-node bulk writers: one bounded queue per node drained by a fixed number of in-flight insert_many calls
+class NodeWriters:
+    def __init__(self, clients, max_in_flight=2, queue_size=4, ignore_duplicates=False):
+        self.clients = clients
+        self.max_in_flight = max_in_flight
+        self.queue_size = queue_size
+        self.ignore_duplicates = ignore_duplicates  # Replays of a resumed load rewrite keys that already landed
+        self.queues = {node: asyncio.Queue(maxsize=queue_size) for node in clients}
+        self.stats = {node: {"batches": 0, "documents": 0} for node in clients}
+        self.workers = []
+        self.error = None
+        self.start_time = None
+
+    def start(self):
+        self.start_time = time.time()
+        for node, queue in self.queues.items():
+            collection = self.clients[node]['mydatabase']['mycollection']
+            for _ in range(self.max_in_flight):
+                self.workers.append(asyncio.create_task(self._worker(node, queue, collection)))
+        return self
+
+    async def _worker(self, node, queue, collection):
+        while True:
+            documents = await queue.get()
+            try:
+                if documents is None:
+                    return
+                if self.error is None:
+                    # The batch is routed with the ring of this generation, so a rebalance waits for it to land
+                    generation = rebalance["generation"]
+                    in_flight = rebalance["writes_in_flight"]
+                    in_flight[generation] = in_flight.get(generation, 0) + 1
+                    try:
+                        for owner, owner_documents in current_owners(node, documents).items():
+                            owner_collection = collection if owner == node else \
+                                mongo_clients[owner]['mydatabase']['mycollection']
+                            start_time = time.perf_counter()
+                            try:
+                                await owner_collection.insert_many(owner_documents, ordered=False)
+                            except BulkWriteError as e:
+                                if not self.ignore_duplicates or \
+                                        any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                                    raise
+                                metrics.count("duplicates_skipped", owner, len(e.details["writeErrors"]))
+                            metrics.observe("insert_batch", owner, time.perf_counter() - start_time)
+                            metrics.count("documents_inserted", owner, len(owner_documents))
+                            stats = self.stats.setdefault(owner, {"batches": 0, "documents": 0})
+                            stats["batches"] += 1
+                            stats["documents"] += len(owner_documents)
+                    finally:
+                        in_flight[generation] -= 1
+                        if not in_flight[generation]:
+                            del in_flight[generation]
+            except Exception as e:
+                self.error = self.error or e
+            finally:
+                queue.task_done()
+
+    # Start a queue and workers for a node that joined after the writers started
+    def add_node(self, node):
+        self.queues[node] = asyncio.Queue(maxsize=self.queue_size)
+        self.stats.setdefault(node, {"batches": 0, "documents": 0})
+        collection = self.clients[node]['mydatabase']['mycollection']
+        for _ in range(self.max_in_flight):
+            self.workers.append(asyncio.create_task(self._worker(node, self.queues[node], collection)))
+
+    # Queue a batch for a node, waiting while the node's queue is full
+    async def submit(self, node, documents):
+        if self.error is not None:
+            raise self.error
+        await self.queues[node].put(documents)
+        metrics.gauge("writer_queue_depth", node, self.queues[node].qsize())
+        await asyncio.sleep(0)  # Let the node's workers pick the batch up
+
+    # Wait for every batch queued so far to be written, leaving the workers running
+    async def drain(self):
+        await asyncio.gather(*(queue.join() for queue in self.queues.values()))
+        if self.error is not None:
+            raise self.error
+
+    # Wait for every queued batch to be written, then stop the workers
+    async def close(self):
+        for queue in self.queues.values():
+            for _ in range(self.max_in_flight):
+                await queue.put(None)
+        await asyncio.gather(*self.workers)
+        self.workers = []
+        if self.error is not None:
+            raise self.error
+
+    def report(self):
+        elapsed_time = max(time.time() - self.start_time, 1e-9)
+        print("\nWriter Throughput:")
+        for node, stats in self.stats.items():
+            print(f"Node: {node} -> {stats['documents']} documents in {stats['batches']} batches, "
+                  f"{stats['documents'] / elapsed_time:.0f} docs/sec")
+
+
+# Function to build each node's documents for a routed chunk of consecutive keys
+def chunk_documents(chunk_start, hashes, node_indices):
+    ids = np.arange(chunk_start, chunk_start + len(hashes))
+    digests = hashes.tobytes()
+    for node_index, node in enumerate(ring_nodes()):
+        node_positions = np.nonzero(node_indices == node_index)[0]
+        if len(node_positions):
+            yield node, [{"_id": str(i), "value": f"value_{i}", "ring_hash": digests[16 * j:16 * j + 16].hex()}
+                         for i, j in zip(ids[node_positions].tolist(), node_positions.tolist())]
+
+
+# Function to make this process route with the given nodes and engine; producer processes call it first
+def use_placement(node_keys, engine):
+    global hash_ring, placement_engine
+    if engine != placement_engine or list(hash_ring.get_nodes()) != node_keys:
+        placement_engine = engine
+        hash_ring = create_placement(node_keys)
+
+
+# Function run in producer processes: route keys start..end-1 and encode each node's documents into one BSON buffer
+def produce_documents(start, end, node_keys, engine):
+    use_placement(node_keys, engine)
+    distribution = KeyDistribution()
+    encoded = {}
+    for chunk_start in range(start, end, routing_chunk_size):
+        chunk_end = min(chunk_start + routing_chunk_size, end)
+        hashes = hash_many([str(i) for i in range(chunk_start, chunk_end)])
+        node_indices = route_hashes(hashes)
+        summarize_chunk(distribution, hashes, node_indices, np.arange(chunk_start, chunk_end))
+        for node, documents in chunk_documents(chunk_start, hashes, node_indices):
+            encoded.setdefault(node, []).extend(bson.encode(document) for document in documents)
+    return {node: b"".join(documents) for node, documents in encoded.items()}, distribution
+
+
+# Async generator fanning key spans out to a process pool and yielding (routed count, buffers, summary) per span
+async def produce_in_processes(num_docs, processes):
+    loop = asyncio.get_running_loop()
+    node_keys = list(hash_ring.get_nodes())
+    spans = iter(range(0, num_docs, routing_chunk_size))
+    routed_count = 0
+    with ProcessPoolExecutor(processes) as executor:
+        def submit(start):
+            return loop.run_in_executor(executor, produce_documents, start, min(start + routing_chunk_size, num_docs),
+                                        node_keys, placement_engine)
+
+        # Two spans per process in flight keeps every core busy without buffering the whole key range
+        pending = {submit(start) for start in itertools.islice(spans, 2 * processes)}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                buffers, part = future.result()
+                pending.update(submit(start) for start in itertools.islice(spans, 1))
+                routed_count += sum(summary.count for summary in part.nodes.values())
+                yield routed_count, buffers, part
+
+
 # Async function to insert documents into MongoDB using bulk insert
 # Modified code to count total documents asynchronously
 # Updated async function to insert documents and analyze key distribution
-async def insert_documents(num_docs, batch_size=100000):
+async def insert_documents(num_docs, batch_size=100000, max_in_flight=2, queue_size=4, processes=1):
     start_time = time.time()
+    # Never route writes with membership older than the last saved snapshot
+    refresh_ring_state()
+    writers = NodeWriters(mongo_clients, max_in_flight, queue_size).start()
     documents_dict = {node: [] for node in mongo_clients}
-    key_ranges = {node: {"min": None, "max": None, "count": 0} for node in mongo_clients}
-
-    for i in range(num_docs):
-        key = str(i)  # Generate unique key
-        node = hash_ring.get_node(key)
-        documents_dict[node].append({"_id": key, "value": f"value_{i}"})
-
-        # Update key range and count for the node
-        if key_ranges[node]["min"] is None or int(key) < int(key_ranges[node]["min"]):
-            key_ranges[node]["min"] = key
-        if key_ranges[node]["max"] is None or int(key) > int(key_ranges[node]["max"]):
-            key_ranges[node]["max"] = key
-        key_ranges[node]["count"] += 1
-
-        if len(documents_dict[node]) == batch_size:
-            mongo_client = mongo_clients[node]
-            db = mongo_client['mydatabase']
-            collection = db['mycollection']
-            await collection.insert_many(documents_dict[node])
+    distribution = KeyDistribution()
+    overflow_count = 0
+    if bounded_load_epsilon is not None:
+        await load_overflow_placements()
+
+    async def queue_documents(node, documents, routed_count):
+        if node not in writers.queues:
+            writers.add_node(node)  # A node added by a rebalance running alongside this insert
             documents_dict[node] = []
-            print(f"Inserted {i + 1} / {num_docs} documents")
+        documents_dict[node].extend(documents)
+        while len(documents_dict[node]) >= batch_size:
+            await writers.submit(node, documents_dict[node][:batch_size])
+            documents_dict[node] = documents_dict[node][batch_size:]
+            print(f"Queued {routed_count} / {num_docs} documents")
+
+    # Bounded loads place keys one after another, so they always run in this process
+    if processes > 1 and bounded_load_epsilon is None:
+        # Producer processes hash, route and encode; this loop only splits their BSON buffers and feeds the writers
+        async for routed_count, buffers, part in produce_in_processes(num_docs, processes):
+            distribution.merge(part)
+            for node, buffer in buffers.items():
+                await queue_documents(node, bson.decode_all(buffer, DEFAULT_RAW_BSON_OPTIONS), routed_count)
+    else:
+        for chunk_start in range(0, num_docs, routing_chunk_size):
+            chunk_end = min(chunk_start + routing_chunk_size, num_docs)
+            keys = [str(i) for i in range(chunk_start, chunk_end)]
+            hashes = hash_many(keys)
+            node_indices = route_hashes(hashes)
+            if bounded_load_epsilon is not None:
+                node_indices, overflowed = place_bounded(keys, node_indices)
+                await record_overflow(overflowed)
+                overflow_count += len(overflowed)
+            summarize_chunk(distribution, hashes, node_indices, np.arange(chunk_start, chunk_end))
+            for node, documents in chunk_documents(chunk_start, hashes, node_indices):
+                await queue_documents(node, documents, chunk_end)
 
     # Insert any remaining documents
     for node, documents in documents_dict.items():
         if documents:
-            mongo_client = mongo_clients[node]
-            db = mongo_client['mydatabase']
-            collection = db['mycollection']
-            await collection.insert_many(documents)
-            print(f"Inserted {num_docs} / {num_docs} documents")
+            await writers.submit(node, documents)
+    await writers.close()
 
     end_time = time.time()
     elapsed_time = end_time - start_time
     print(f"Inserted {num_docs} documents in {elapsed_time} seconds")
+    writers.report()
+    if bounded_load_epsilon is not None:
+        print(f"Bounded loads (epsilon {bounded_load_epsilon}): {overflow_count} keys moved off a full node")
 
     # Display key distribution analysis
     print("\nKey Distribution Analysis:")
-    for node, range_info in key_ranges.items():
-        print(f"Node: {node}")
-        print(f"  Min Key: {range_info['min']}")
-        print(f"  Max Key: {range_info['max']}")
-        print(f"  Total Keys: {range_info['count']}")
-        print()
+    distribution.report()
+    return distribution
+
+
+# Async function to stream records from a JSONL or CSV file to their ring owners, resumable from a byte offset
+async def bulk_load(path, file_format=None, key_field="_id", batch_size=10000, max_in_flight=2, queue_size=4,
+                    checkpoint_path=None, checkpoint_every=100000, resume=False, start_offset=None):
+    """Load one file; only a routing chunk, the per-node buffers and the writer queues are held in memory."""
+    file_format = file_format or detect_format(path)
+    checkpoint_path = checkpoint_path or f"{path}.offset"
+    offset, loaded_count = read_load_checkpoint(checkpoint_path) if resume else (0, 0)
+    if start_offset is not None:
+        offset = start_offset
+    if offset:
+        print(f"Resuming {path} from byte {offset} ({loaded_count} rows loaded before)")
+
+    refresh_ring_state()
+    if bounded_load_epsilon is not None:
+        await load_overflow_placements()
+    # Rows written after the last checkpoint are replayed on resume, so keys already stored are not errors
+    writers = NodeWriters(mongo_clients, max_in_flight, queue_size, ignore_duplicates=True).start()
+    documents_dict = {node: [] for node in mongo_clients}
+    records = read_records(path, file_format, offset)
+    file_size = os.path.getsize(path)
+    start_time = time.time()
+    row_count = 0
+    skipped_count = 0
+    checkpointed_count = 0
+
+    async def queue_documents(node, documents):
+        if node not in writers.queues:
+            writers.add_node(node)  # A node added by a rebalance running alongside this load
+            documents_dict[node] = []
+        documents_dict[node].extend(documents)
+        while len(documents_dict[node]) >= batch_size:
+            await writers.submit(node, documents_dict[node][:batch_size])
+            documents_dict[node] = documents_dict[node][batch_size:]
+
+    async def flush_documents():
+        for node, documents in documents_dict.items():
+            if documents:
+                await writers.submit(node, documents)
+                documents_dict[node] = []
+
+    try:
+        while True:
+            chunk = list(itertools.islice(records, min(routing_chunk_size, checkpoint_every)))
+            if not chunk:
+                break
+            offset = chunk[-1][0]
+            documents = []
+            for record_offset, record in chunk:
+                key = record.get(key_field)
+                if key is None or key == "":
+                    skipped_count += 1
+                    # Name the first few so they can be found in the file; the rest are only counted
+                    if skipped_count <= 5:
+                        print(f"Skipping the record ending at byte {record_offset}: it has no {key_field!r} field")
+                    continue
+                record["_id"] = str(key)
+                documents.append(record)
+            if not documents:
+                continue
+
+            keys = [document["_id"] for document in documents]
+            hashes = hash_many(keys)
+            node_indices = route_hashes(hashes)
+            if bounded_load_epsilon is not None:
+                node_indices, overflowed = place_bounded(keys, node_indices)
+                await record_overflow(overflowed)
+            digests = hashes.tobytes()
+            for i, document in enumerate(documents):
+                document["ring_hash"] = digests[16 * i:16 * i + 16].hex()
+            for node_index, node in enumerate(ring_nodes()):
+                node_positions = np.nonzero(node_indices == node_index)[0]
+                if len(node_positions):
+                    await queue_documents(node, [documents[j] for j in node_positions.tolist()])
+            row_count += len(documents)
+            metrics.count("rows_loaded", value=len(documents))
+
+            # Only commit an offset once every row before it is stored
+            if row_count - checkpointed_count >= checkpoint_every:
+                await flush_documents()
+                await writers.drain()
+                save_load_checkpoint(checkpoint_path, offset, loaded_count + row_count)
+                checkpointed_count = row_count
+                elapsed_time = max(time.time() - start_time, 1e-9)
+                print(f"Loaded {loaded_count + row_count} rows, byte {offset} of {file_size} "
+                      f"({offset / file_size:.1%}), {row_count / elapsed_time:.0f} rows/sec")
+    except BaseException:
+        # Rows after the last checkpoint are replayed on resume; stop the writers instead of leaving them waiting
+        for worker in writers.workers:
+            worker.cancel()
+        raise
+
+    await flush_documents()
+    await writers.close()
+    save_load_checkpoint(checkpoint_path, offset, loaded_count + row_count)
+
+    elapsed_time = time.time() - start_time
+    print(f"Loaded {row_count} rows from {path} in {elapsed_time} seconds "
+          f"({row_count / max(elapsed_time, 1e-9):.0f} rows/sec)")
+    if skipped_count:
+        print(f"Skipped {skipped_count} records without a {key_field!r} field")
+    print(f"Checkpoint saved to {checkpoint_path} at byte {offset}")
+    writers.report()
+    return row_count
+
+
+# Read-through document cache: bounded LRU with optional TTL, each entry tagged with the node it was read from
+class DocumentCache:
+    def __init__(self, max_entries=100000, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (document, node, expires_at)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Return the cached document if it was read from the node that owns the key now
+    def get(self, key, node):
+        entry = self.entries.get(key)
+        if entry is not None:
+            document, cached_node, expires_at = entry
+            if cached_node == node and (expires_at is None or expires_at > time.monotonic()):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return document
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+    # Return (node, document) for a live entry without counting a lookup or dropping an entry tagged with another node
+    def peek(self, key):
+        entry = self.entries.get(key)
+        if entry is None or (entry[2] is not None and entry[2] <= time.monotonic()):
+            return None
+        return entry[1], entry[0]
+
+    def put(self, key, node, document):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        self.entries[key] = (document, node, expires_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, keys):
+        for key in keys:
+            self.entries.pop(key, None)
+
+    # Drop every entry read from a node
+    def invalidate_node(self, node):
+        for key in [key for key, entry in self.entries.items() if entry[1] == node]:
+            del self.entries[key]
+
+    # Point entries at the nodes that own their keys after a migration copied the documents there
+    def retag(self, owners):
+        for key, owner in owners.items():
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries[key] = (entry[0], owner, entry[2])
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+# Cache in front of find_document and find_documents
+document_cache = DocumentCache()
 
 
 # Async function to delete all documents from the collection
 async def delete_all_documents():
+    document_cache.clear()
+    overflow_placements.clear()
+    node_loads.clear()
     try:
         for client in mongo_clients.values():
+            await client['mydatabase']['overflow_keys'].delete_many({})
             db = client['mydatabase']
             collection = db['mycollection']
             result = await collection.delete_many({})
@@ -85,100 +690,604 @@ async def delete_all_documents():
 
 # Async function to find a document by key
 async def find_document(key):
-    start_time = time.time()
-    node = hash_ring.get_node(key)
-    print(f'This is the node {node}')
-    mongo_client = mongo_clients[node]
-    db = mongo_client['mydatabase']
-    collection = db['mycollection']
-    document = await collection.find_one({"_id": key})
-    end_time = time.time()
-    elapsed_time = end_time - start_time
-    if document:
-        print(f"Document with key '{key}' found in {elapsed_time} seconds: {document}")
-    else:
-        print(f"Document with key '{key}' not found")
+    start_time = time.perf_counter()
+    node = overflow_placements.get(key) or hash_ring.get_node(key)
+    previous_node = previous_owner(key, node)
+    # get() drops entries tagged with another node, so a key still cached from its previous owner is looked up there
+    cached = document_cache.peek(key) if previous_node is not None else None
+    if cached is not None and cached[0] == previous_node:
+        node = previous_node
+    document = document_cache.get(key, node)
+    if document is None:
+        mongo_client = mongo_clients[node]
+        db = mongo_client['mydatabase']
+        collection = db['mycollection']
+        document = await collection.find_one({"_id": key})
+        if document is None and previous_node is not None:
+            # The key's arc is still being migrated, so its previous owner may hold it
+            metrics.count("dual_reads", previous_node)
+            document = await node_client(previous_node)['mydatabase']['mycollection'].find_one({"_id": key})
+            if document is not None:
+                node = previous_node
+            else:
+                # Migrations copy before they delete, so a document missing from both moved between the reads
+                document = await collection.find_one({"_id": key})
+        if document:
+            document_cache.put(key, node, document)
+    metrics.observe("find", node, time.perf_counter() - start_time)
+    return document
+
+
+# Async function to find many documents at once with one $in query per owning node
+async def find_documents(keys):
+    """Return the documents for keys in input order, with None for keys that were not found."""
+    if not keys:
+        return []
+    node_indices = route_many(keys)
+    nodes = ring_nodes()
+    found = {}
+    grouped_keys = {}
+    owners = {}
+    for key, node_index in zip(keys, node_indices.tolist()):
+        owners[key] = cached_node = nodes[node_index]
+        if rebalance["previous_ring"] is not None:
+            cached = document_cache.peek(key)
+            if cached is not None and cached[0] == previous_owner(key, owners[key]):
+                cached_node = cached[0]
+        document = document_cache.get(key, cached_node)
+        if document is not None:
+            found[key] = document
+        else:
+            grouped_keys.setdefault(nodes[node_index], []).append(key)
+
+    async def find_on_node(node, node_keys):
+        start_time = time.perf_counter()
+        collection = node_client(node)['mydatabase']['mycollection']
+        documents = [document async for document in collection.find({"_id": {"$in": node_keys}})]
+        metrics.observe("find_many", node, time.perf_counter() - start_time)
+        for document in documents:
+            document_cache.put(document["_id"], node, document)
+        return documents
+
+    async def find_grouped(grouped_keys):
+        for documents in await asyncio.gather(*(find_on_node(node, node_keys)
+                                                for node, node_keys in grouped_keys.items())):
+            found.update((document["_id"], document) for document in documents)
+
+    await find_grouped(grouped_keys)
+
+    # During a rebalance, keys on moving arcs that the new owner lacks are read from their previous owner
+    moving_keys = [key for key in keys if key not in found and previous_owner(key, owners[key]) is not None]
+    if moving_keys:
+        previous_keys = {}
+        for key in moving_keys:
+            previous_keys.setdefault(previous_owner(key, owners[key]), []).append(key)
+            metrics.count("dual_reads", previous_owner(key, owners[key]))
+        await find_grouped(previous_keys)
+        # Anything still missing may have been copied to the new owner between the two reads
+        retry_keys = {}
+        for key in moving_keys:
+            if key not in found:
+                retry_keys.setdefault(owners[key], []).append(key)
+        await find_grouped(retry_keys)
+    return [found.get(key) for key in keys]
+
+
+# Async function to read a node's sorted cursor one batch ahead of the merge in scan
+async def read_sorted_batches(cursor, queue, batch_size):
+    documents = []
+    try:
+        async for document in cursor:
+            documents.append(document)
+            if len(documents) == batch_size:
+                await queue.put(documents)
+                documents = []
+        if documents:
+            await queue.put(documents)
+    except Exception as e:
+        await queue.put(e)
+    await queue.put(None)
+
+
+# Async generator over the documents with start <= _id < end on every node, in _id order
+async def scan(start=None, end=None, limit=None, batch_size=1000):
+    """Yield up to limit documents from a lazy merge of every node's sorted cursor; each node buffers a few batches."""
+    bounds = {}
+    if start is not None:
+        bounds["$gte"] = start
+    if end is not None:
+        bounds["$lt"] = end
+    query = {"_id": bounds} if bounds else {}
+    if limit is not None:
+        if limit <= 0:
+            return
+        batch_size = min(batch_size, limit)
+
+    # Nodes being drained by a rebalance may still hold part of the range
+    clients = dict(rebalance["clients"])
+    clients.update(mongo_clients)
+    nodes = list(clients)
+    start_time = time.perf_counter()
+    queues = []
+    readers = []
+    for node in nodes:
+        cursor = clients[node]['mydatabase']['mycollection'].find(query).sort("_id", 1).batch_size(batch_size)
+        if limit is not None:
+            cursor = cursor.limit(limit)  # No node can contribute more than the whole result
+        queues.append(asyncio.Queue(maxsize=1))
+        readers.append(asyncio.create_task(read_sorted_batches(cursor, queues[-1], batch_size)))
+
+    async def next_batch(node_index):
+        batch = await queues[node_index].get()
+        if isinstance(batch, Exception):
+            raise batch
+        return batch
+
+    scanned_count = 0
+    try:
+        # Heap of (key, node index, position in the node's current batch), one entry per node with documents left
+        batches = await asyncio.gather(*(next_batch(node_index) for node_index in range(len(nodes))))
+        heap = [(batch[0]["_id"], node_index, 0) for node_index, batch in enumerate(batches) if batch]
+        heapq.heapify(heap)
+        last_key = None
+        while heap:
+            key, node_index, position = heap[0]
+            # A key copied by a migration but not yet deleted from its source comes up twice in a row
+            if scanned_count == 0 or key != last_key:
+                last_key = key
+                yield batches[node_index][position]
+                scanned_count += 1
+                if scanned_count == limit:
+                    return
+
+            position += 1
+            if position == len(batches[node_index]):
+                batches[node_index] = await next_batch(node_index)
+                position = 0
+            if batches[node_index]:
+                heapq.heapreplace(heap, (batches[node_index][position]["_id"], node_index, position))
+            else:
+                heapq.heappop(heap)
+    finally:
+        for reader in readers:
+            reader.cancel()
+        metrics.observe("scan", "", time.perf_counter() - start_time)
+        metrics.count("documents_scanned", value=scanned_count)
+
+
+# Preference lists cached per vnode position, reset whenever uhashring replaces its sorted key list
+_preference_cache = {"keys": None, "lists": {}}
+
+
+# Function to get the N distinct nodes responsible for a key, walking the ring clockwise
+def preference_list(key, n=2):
+    """Return up to n distinct nodes clockwise from the key's hash; the first one is the owner."""
+    if not isinstance(hash_ring, HashRing):
+        return hash_ring.preference_list(key, n)
+    ring_keys = hash_ring._keys
+    if not ring_keys:
+        return ()
+    if _preference_cache["keys"] is not ring_keys:
+        _preference_cache["keys"] = ring_keys
+        _preference_cache["lists"] = {}
+
+    position = bisect(ring_keys, hash_ring.hashi(key))
+    if position == len(ring_keys):
+        position = 0
+
+    # Every key between two consecutive vnodes shares the same preference list
+    nodes = _preference_cache["lists"].get((position, n))
+    if nodes is None:
+        nodes = []
+        for offset in range(len(ring_keys)):
+            node = hash_ring.ring[ring_keys[(position + offset) % len(ring_keys)]]
+            if node not in nodes:
+                nodes.append(node)
+                if len(nodes) == n:
+                    break
+        nodes = tuple(nodes)
+        _preference_cache["lists"][(position, n)] = nodes
+    return nodes
 
 
 # Function to get the next node in the hash ring in clockwise direction
 def get_next_node(node_key):
     """Get the next node in the hash ring in clockwise direction."""
-    if not hash_ring.sorted_keys:
-        return None
-
-    # Calculate the hash value for the given node_key
-    hash_value = hash_ring._hash_function(node_key)
+    nodes = preference_list(node_key, 1)
+    return nodes[0] if nodes else None
+
+
+# Bounded-load placement: None keeps pure hashing, otherwise every node is capped at (1 + epsilon) x the average load
+bounded_load_epsilon = None
+
+# Keys placed on a node other than their hash owner, and the number of keys stored on each node
+overflow_placements = {}
+node_loads = {}
+
+
+# Function to apply bounded loads to routed keys, walking clockwise past nodes that are at capacity
+def place_bounded(keys, node_indices):
+    """Return (node_indices, overflowed): adjusted indices into ring_nodes() and the keys moved off their owner."""
+    nodes = ring_nodes()
+    node_index = {node: index for index, node in enumerate(nodes)}
+    placed = sum(node_loads.get(node, 0) for node in nodes)
+    node_indices = node_indices.copy()
+    overflowed = {}
+    for i, (key, owner_index) in enumerate(zip(keys, node_indices.tolist())):
+        placed += 1
+        capacity = math.ceil((1 + bounded_load_epsilon) * placed / len(nodes))
+        node = nodes[owner_index]
+        if node_loads.get(node, 0) >= capacity:
+            # Loads add up to placed - 1 < capacity x nodes, so some node always has room
+            node = next(candidate for candidate in preference_list(key, len(nodes))
+                        if node_loads.get(candidate, 0) < capacity)
+            node_indices[i] = node_index[node]
+            overflowed[key] = node
+        node_loads[node] = node_loads.get(node, 0) + 1
+    overflow_placements.update(overflowed)
+    return node_indices, overflowed
+
+
+# Async function to persist overflow decisions next to the documents they moved
+async def record_overflow(overflowed):
+    grouped_keys = {}
+    for key, node in overflowed.items():
+        grouped_keys.setdefault(node, []).append({"_id": key})
+    for node, entries in grouped_keys.items():
+        try:
+            await mongo_clients[node]['mydatabase']['overflow_keys'].insert_many(entries, ordered=False)
+        except BulkWriteError as e:
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
 
-    # Find the next hash key in the sorted list
-    for hash_key in hash_ring.sorted_keys:
-        if hash_value < hash_key:
-            return hash_ring.ring[hash_key]
 
-    # If no larger hash key is found, wrap around to the first node
-    return hash_ring.ring[hash_ring.sorted_keys[0]]
+# Async function to reload overflow decisions and per-node loads, e.g. after a restart
+async def load_overflow_placements():
+    overflow_placements.clear()
+    for node, client in mongo_clients.items():
+        async for entry in client['mydatabase']['overflow_keys'].find({}):
+            overflow_placements[entry["_id"]] = node
+        node_loads[node] = await client['mydatabase']['mycollection'].count_documents({})
 
 
-# Optimized async function to remove a node and migrate data efficiently
-async def remove_node_and_migrate_data(host, port, batch_size=100000):
-    node_key = f"{host}:{port}"
-    hash_ring.remove_node(node_key)  # Remove the node from the HashRing
-    mongo_client = mongo_clients.pop(node_key, None)  # Remove the MongoDB client
+# Rebalance in progress: the ring before the membership change, clients of drained nodes, the ring generation
+# (bumped at every membership change) and the number of inserts running per generation they were routed in
+rebalance = {"previous_ring": None, "clients": {}, "generation": 0, "writes_in_flight": {}}
 
-    if mongo_client:
-        print(f"Removing node: {node_key} and redistributing data among remaining nodes")
-        try:
-            db = mongo_client['mydatabase']
-            collection = db['mycollection']
 
-            # Retrieve all documents from the removed node
-            total_docs = await collection.count_documents({})
-            print(f"Total documents to transfer: {total_docs}")
+# Async function to start routing reads on moving keys to both owners, once writes routed by the old ring have landed
+async def begin_rebalance(previous_ring, clients=None):
+    rebalance["previous_ring"] = previous_ring
+    rebalance["clients"] = clients or {}
+    # Inserts that started before the ring changed may target the old owner; the migration must see them.
+    # Inserts starting from here on are re-routed by the new ring, so only the older generations are waited for
+    previous_generation = rebalance["generation"]
+    rebalance["generation"] += 1
+    while any(generation <= previous_generation for generation in rebalance["writes_in_flight"]):
+        await asyncio.sleep(0.001)
 
-            if total_docs > 0:
-                # Use an indexed field (_id) for efficient pagination
-                last_id = None
 
-                while True:
-                    query = {"_id": {"$gt": last_id}} if last_id else {}
-                    documents = await collection.find(query).limit(batch_size).to_list(batch_size)
+def end_rebalance():
+    rebalance["previous_ring"] = None
+    rebalance["clients"] = {}
 
-                    if not documents:
-                        break
 
-                    # Determine the new nodes for each document and group them for batch insertion
-                    grouped_documents = {}
-                    for document in documents:
-                        key = document["_id"]
-                        new_node = hash_ring.get_node(key)  # Get the new node for the document
-                        if new_node not in grouped_documents:
-                            grouped_documents[new_node] = []
-                        grouped_documents[new_node].append(document)
-
-                    # Batch insert documents into the new nodes
-                    for new_node, docs in grouped_documents.items():
-                        new_mongo_client = mongo_clients[new_node]
-                        new_db = new_mongo_client['mydatabase']
-                        new_collection = new_db['mycollection']
-                        await new_collection.insert_many(docs)
+# Function to get the node a key lived on before the rebalance in progress; None when the key isn't moving
+def previous_owner(key, owner):
+    previous_ring = rebalance["previous_ring"]
+    if previous_ring is None:
+        return None
+    node = previous_ring.get_node(key)
+    return node if node != owner else None
+
+
+# Function to get the client for a node in the ring or one being drained
+def node_client(node):
+    return mongo_clients.get(node) or rebalance["clients"][node]
+
+
+# Function to group a batch queued for a node by the keys' current owners; it only splits across a rebalance
+def current_owners(node, documents):
+    if rebalance["previous_ring"] is None and node in mongo_clients:
+        return {node: documents}
+    nodes = ring_nodes()
+    grouped_documents = {}
+    for document, node_index in zip(documents, route_many([doc["_id"] for doc in documents]).tolist()):
+        grouped_documents.setdefault(nodes[node_index], []).append(document)
+    return grouped_documents
+
+
+# Function to capture the ring's vnode positions and owners around a membership change
+def ring_snapshot(ring=None):
+    ring = ring or hash_ring
+    if not isinstance(ring, HashRing):
+        return [], {}
+    return list(ring._keys), dict(ring.ring)
+
+
+# Function to save the ring under the next epoch after a membership change
+def save_ring_state():
+    global ring_epoch
+    ring_epoch = max(ring_epoch, read_epoch(ring_state_path) or 0) + 1
+    RingSnapshot.capture(hash_ring, placement_engine, ring_epoch).save(ring_state_path)
+
+
+# Function to switch to the ring in a snapshot file, connecting to nodes this process doesn't know yet
+def load_ring_state(path=None):
+    global hash_ring, placement_engine, ring_epoch
+    snapshot = RingSnapshot.load(path or ring_state_path)
+    hash_ring = snapshot.placement()
+    placement_engine = snapshot.engine
+    ring_epoch = snapshot.epoch
+    if isinstance(hash_ring, HashRing):
+        # The mapped arrays are the routing arrays, so get_ring_arrays has nothing to rebuild
+        _ring_arrays.update(keys=hash_ring._keys, nodes=snapshot.node_names(), high=snapshot.high,
+                            owners=snapshot.owners.astype(np.intp))
+
+    nodes = snapshot.node_names()
+    for node in nodes:
+        if node not in mongo_clients:
+            mongo_clients[node] = create_client(node.split(":")[0], int(node.split(":")[1]))
+    for node in [node for node in mongo_clients if node not in nodes]:
+        mongo_clients.pop(node).close()
+    return snapshot
+
+
+# Function to reload the ring when another router saved a newer epoch; returns True if it did
+def refresh_ring_state():
+    epoch = read_epoch(ring_state_path)
+    if epoch is None or epoch <= ring_epoch:
+        return False
+    print(f"Ring epoch {ring_epoch} is stale, loading epoch {epoch} from {ring_state_path}")
+    load_ring_state()
+    return True
+
+
+# Start from the ring saved by the last membership change instead of mongodb_nodes
+if os.path.exists(ring_state_path):
+    load_ring_state()
+
+
+# Function to find the hash arcs whose owner differs between two ring snapshots
+def changed_arcs(old_snapshot, new_snapshot):
+    """Return (low, high, old_node, new_node) tuples; hashes in [low, high) changed owner, high None is the ring end."""
+    old_keys, old_ring = old_snapshot
+    new_keys, new_ring = new_snapshot
+    if not old_keys or not new_keys:
+        return []
+
+    # Every vnode of either ring is an arc boundary; a hash belongs to the first vnode strictly above it
+    boundaries = sorted(set(old_keys) | set(new_keys))
+    arcs = []
+    for low, high in zip([0] + boundaries, boundaries + [None]):
+        old_node = old_ring[old_keys[bisect_left(old_keys, high) % len(old_keys)]] if high is not None \
+            else old_ring[old_keys[0]]
+        new_node = new_ring[new_keys[bisect_left(new_keys, high) % len(new_keys)]] if high is not None \
+            else new_ring[new_keys[0]]
+        if old_node == new_node:
+            continue
+        if arcs and arcs[-1][1] == low and arcs[-1][2:] == (old_node, new_node):
+            arcs[-1] = (arcs[-1][0], high, old_node, new_node)
+        else:
+            arcs.append((low, high, old_node, new_node))
+    return arcs
+
+
+# Function to build the ring_hash filter for an arc
+def ring_hash_range(low, high):
+    bounds = {"$gte": f"{low:032x}"}
+    if high is not None:
+        bounds["$lt"] = f"{high:032x}"
+    return {"ring_hash": bounds}
+
+
+# Adaptive migration pacing: AIMD on batch size and inter-batch delay, driven by observed write latency
+class MigrationThrottle:
+    def __init__(self, target_latency=0.25, initial_batch_size=1000, min_batch_size=100, max_batch_size=50000,
+                 max_delay=2.0):
+        self.target_latency = target_latency
+        self.step = initial_batch_size
+        self.batch_size = initial_batch_size
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.delay = 0.0
+
+    def observe(self, latency):
+        if latency > self.target_latency:
+            # Back off quickly so foreground traffic keeps its latency targets
+            self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+            self.delay = min(self.max_delay, max(2 * self.delay, 0.01))
+        else:
+            self.batch_size = min(self.max_batch_size, self.batch_size + self.step)
+            self.delay = self.delay / 2 if self.delay >= 0.002 else 0.0
+
+
+# Async function to read a cursor ahead of the migration writes in throttle-sized batches
+async def read_ahead(cursor, queue, throttle):
+    documents = []
+    try:
+        async for document in cursor:
+            documents.append(document)
+            if len(documents) >= throttle.batch_size:
+                await queue.put(documents)
+                documents = []
+        if documents:
+            await queue.put(documents)
+    except Exception as e:
+        await queue.put(e)
+    await queue.put(None)
+
+
+# Function to read a raw BSON document's _id without decoding the rest; MongoDB stores _id as the first field
+def raw_id(document):
+    raw = document.raw
+    element = raw[4:9]
+    if element == b"\x02_id\x00":  # String
+        return raw[13:12 + int.from_bytes(raw[9:13], "little")].decode("utf-8")
+    if element == b"\x10_id\x00":  # 32-bit integer
+        return int.from_bytes(raw[9:13], "little", signed=True)
+    if element == b"\x12_id\x00":  # 64-bit integer
+        return int.from_bytes(raw[9:17], "little", signed=True)
+    if element == b"\x07_id\x00":
+        return bson.ObjectId(raw[9:21])
+    return document["_id"]
+
+
+# Async function to insert a migrated batch, treating documents already copied by an interrupted run as done
+async def insert_migrated_documents(node, documents):
+    try:
+        await mongo_clients[node]['mydatabase']['mycollection'].insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+            raise
+
+
+# Async function to stream documents from a node to their current ring owners, resumable from a checkpoint
+async def migrate_documents(label, source_node, source_client, query, sort_field="_id", throttle=None,
+                            read_ahead_batches=2):
+    throttle = throttle or MigrationThrottle()
+    collection = source_client['mydatabase']['mycollection']
+    # Documents are read as raw BSON and forwarded as-is; only their _id is parsed, for routing
+    raw_collection = collection.with_options(codec_options=DEFAULT_RAW_BSON_OPTIONS)
+    checkpoints = source_client['mydatabase']['migration_checkpoints']
+
+    checkpoint = await checkpoints.find_one({"_id": label})
+    if checkpoint:
+        query = {"$and": [query, {sort_field: {"$gt": checkpoint["last"]}}]}
+        print(f"Resuming {label} after {sort_field}: {checkpoint['last']}")
+
+    queue = asyncio.Queue(maxsize=read_ahead_batches)
+    cursor = raw_collection.find(query).sort(sort_field, 1).batch_size(throttle.batch_size)
+    reader = asyncio.create_task(read_ahead(cursor, queue, throttle))
+    start_time = time.time()
+    migrated_count = 0
 
-                    # Batch delete documents from the old node
-                    keys_to_delete = [doc["_id"] for doc in documents]
-                    await collection.delete_many({"_id": {"$in": keys_to_delete}})
+    try:
+        while True:
+            documents = await queue.get()
+            if documents is None:
+                break
+            if isinstance(documents, Exception):
+                raise documents
+
+            # Group the batch by owner; anything the source still owns stays where it is
+            keys = [raw_id(document) for document in documents]
+            node_indices = route_many(keys)
+            nodes = ring_nodes()
+            grouped_documents = {}
+            keys_to_delete = []
+            for key, document, node_index in zip(keys, documents, node_indices.tolist()):
+                if nodes[node_index] != source_node:
+                    grouped_documents.setdefault(nodes[node_index], []).append(document)
+                    keys_to_delete.append(key)
+
+            write_start = time.perf_counter()
+            await asyncio.gather(*(insert_migrated_documents(node, docs) for node, docs in grouped_documents.items()))
+            if keys_to_delete:
+                await collection.delete_many({"_id": {"$in": keys_to_delete}})
+            write_latency = time.perf_counter() - write_start
+            throttle.observe(write_latency)
+            metrics.observe("migrate_batch", source_node, write_latency)
+            metrics.count("documents_migrated", source_node, len(keys_to_delete))
+            metrics.count("bytes_migrated", source_node,
+                          sum(len(doc.raw) for docs in grouped_documents.values() for doc in docs))
+            metrics.gauge("migration_queue_depth", source_node, queue.qsize())
+
+            last = keys[-1] if sort_field == "_id" else documents[-1][sort_field]
+            await checkpoints.replace_one({"_id": label}, {"_id": label, "last": last}, upsert=True)
+            migrated_count += len(keys_to_delete)
+            print(f"Migrated {migrated_count} documents up to {sort_field}: {last} "
+                  f"(next batch size {throttle.batch_size})")
+
+            if throttle.delay:
+                await asyncio.sleep(throttle.delay)
+    finally:
+        reader.cancel()
+
+    await checkpoints.delete_one({"_id": label})
+    elapsed_time = time.time() - start_time
+    print(f"{label}: migrated {migrated_count} documents in {elapsed_time} seconds")
+    return migrated_count
+
+
+# Function to re-tag documents cached from a node once a migration has moved them to their owners
+def retag_cached_documents(source_node):
+    keys = [key for key, entry in document_cache.entries.items() if entry[1] == source_node]
+    if keys:
+        nodes = ring_nodes()
+        document_cache.retag({key: nodes[node_index] for key, node_index in zip(keys, route_many(keys).tolist())})
 
-                    # Update last_id for pagination
-                    last_id = documents[-1]["_id"]
 
-                    print(f"Transferred batch up to _id: {last_id}")
+# Optimized async function to remove a node and migrate data efficiently
+async def remove_node_and_migrate_data(host, port, throttle=None):
+    """Drain a node onto the rest of the ring; rerunning it after a failed drain resumes from the checkpoint."""
+    node_key = f"{host}:{port}"
+    label = f"drain:{node_key}"
+    refresh_ring_state()
+    if node_key in hash_ring.get_nodes():
+        previous_ring = copy.deepcopy(hash_ring)
+        hash_ring.remove_node(node_key)  # Remove the node from the HashRing
+        mongo_client = mongo_clients.pop(node_key, None)  # Remove the MongoDB client
+        save_ring_state()
+    else:
+        # The node already left the ring; resume its drain if one failed, here or in an earlier process
+        mongo_client = rebalance["clients"].get(node_key)
+        previous_ring = rebalance["previous_ring"]
+        if mongo_client is None:
+            mongo_client = create_client(host, port)
+            checkpoints = [mongo_client['mydatabase']['migration_checkpoints'].find_one({"_id": label})]
+            checkpoints += [client['mydatabase']['migration_checkpoints'].find_one({"_id": f"remove:{node_key}"})
+                            for client in mongo_clients.values()]
+            if not any(await asyncio.gather(*checkpoints)):
+                mongo_client.close()
+                mongo_client = None
+        if mongo_client is not None and previous_ring is None:
+            previous_ring = copy.deepcopy(hash_ring)
+            previous_ring.add_node(node_key)
+        if mongo_client is not None:
+            print(f"Resuming the drain of {node_key}")
+
+    if not mongo_client:
+        print(f"Node {node_key} was not found in the cluster.")
+        return
+    await begin_rebalance(previous_ring, {node_key: mongo_client})
 
-                print(f"Transferred {total_docs} documents to appropriate nodes")
+    # Keys that overflowed onto the removed node go back to their hash owners with the rest of its data
+    for key in [key for key, node in overflow_placements.items() if node == node_key]:
+        del overflow_placements[key]
+    node_loads.pop(node_key, None)
 
-            # Clean up the removed node's collection
-            await collection.delete_many({})
+    print(f"Removing node: {node_key} and redistributing data among remaining nodes")
+    try:
+        db = mongo_client['mydatabase']
+        collection = db['mycollection']
 
-        except Exception as e:
-            print(f"Error migrating documents: {e}")
-    else:
-        print(f"Node {node_key} was not found in the cluster.")
+        total_docs = await collection.estimated_document_count()
+        print(f"Total documents to transfer: {total_docs}")
+
+        if total_docs > 0:
+            # Every arc the removed node owned changes hands, so drain the whole collection in _id order
+            migrated_count = await migrate_documents(label, node_key, mongo_client, {}, throttle=throttle)
+            print(f"Transferred {migrated_count} documents to appropriate nodes")
+            retag_cached_documents(node_key)
+
+        # Clean up the removed node's collections
+        await collection.delete_many({})
+        await db['overflow_keys'].delete_many({})
+
+        # Jump and Maglev also move keys between the surviving nodes, so scan those as add_node_and_migrate_data does
+        if placement_engine in ("jump", "maglev"):
+            for surviving_node, surviving_client in list(mongo_clients.items()):
+                migrated_count = await migrate_documents(f"remove:{node_key}", surviving_node, surviving_client, {},
+                                                         throttle=throttle)
+                print(f"Moved {migrated_count} documents from {surviving_node} to their new owners")
+                retag_cached_documents(surviving_node)
+    except Exception as e:
+        # Reads keep falling back to the drained node until a rerun finishes the drain
+        print(f"Error migrating documents: {e}")
+        raise
+    end_rebalance()
 
 
 # Function to get the previous node in the hash ring in counter-clockwise direction
@@ -189,93 +1298,104 @@ def get_previous_node(node_key):
     return nodes[previous_index]
 
 
-async def add_node_and_migrate_data(host, port, batch_size=10000):
+async def add_node_and_migrate_data(host, port, throttle=None):
+    """Move the new node's share of the keys onto it; rerunning it after a failed migration resumes from checkpoints."""
     new_node_key = f"{host}:{port}"
-    hash_ring.add_node(new_node_key)
-    mongo_clients[new_node_key] = AsyncIOMotorClient(host, port)
+    label = f"add:{new_node_key}"
+    refresh_ring_state()
+    if new_node_key not in hash_ring.get_nodes():
+        previous_ring = copy.deepcopy(hash_ring)
+        hash_ring.add_node(new_node_key)
+        mongo_clients[new_node_key] = create_client(host, port)
+        save_ring_state()
+        # Marks the add as unfinished until every node has handed its keys over
+        await mongo_clients[new_node_key]['mydatabase']['migration_checkpoints'].replace_one(
+            {"_id": label}, {"_id": label}, upsert=True)
+    else:
+        # The node already joined the ring; resume its migration if one failed, here or in an earlier process
+        previous_ring = rebalance["previous_ring"]
+        if previous_ring is None or new_node_key in previous_ring.get_nodes():
+            checkpoints = await asyncio.gather(*(client['mydatabase']['migration_checkpoints'].find_one({"_id": label})
+                                                 for client in mongo_clients.values()))
+            if not any(checkpoints):
+                print(f"Node {new_node_key} is already in the cluster.")
+                return
+            previous_ring = copy.deepcopy(hash_ring)
+            previous_ring.remove_node(new_node_key)
+        print(f"Resuming the migration to {new_node_key}")
+    await begin_rebalance(previous_ring)
+    await ensure_ring_hash_index({new_node_key: mongo_clients[new_node_key]})
     print(f"Added new node: {new_node_key}")
 
-    for current_node_key, mongo_client in mongo_clients.items():
-        if current_node_key == new_node_key:
-            continue  # Skip the new node
-
-        db = mongo_client['mydatabase']
-        collection = db['mycollection']
-
-        print(f"Analyzing documents from {current_node_key} for migration to {new_node_key}...")
-
-        total_docs = await collection.count_documents({})
-        print(f"Total documents on {current_node_key}: {total_docs}")
-
-        last_id = None
-        migrated_count = 0
-
-        try:
-            while True:
-                # Fetch documents in batches
-                query = {"_id": {"$gt": last_id}} if last_id else {}
-                documents = await collection.find(query).limit(batch_size).to_list(batch_size)
-
-                if not documents:
-                    break
-
-                # Filter documents that need to be migrated to the new node
-                docs_to_migrate = [
-                    doc for doc in documents if hash_ring.get_node(doc["_id"]) == new_node_key
-                ]
-
-                if docs_to_migrate:
-                    # Insert into the new node
-                    new_mongo_client = mongo_clients[new_node_key]
-                    new_db = new_mongo_client['mydatabase']
-                    new_collection = new_db['mycollection']
-
-                    try:
-                        await new_collection.insert_many(docs_to_migrate)
-                        migrated_count += len(docs_to_migrate)
-                    except Exception as e:
-                        print(f"Error inserting documents to {new_node_key}: {e}")
-                        continue
-
-                    # Delete successfully migrated documents from the source node
-                    keys_to_delete = [doc["_id"] for doc in docs_to_migrate]
-                    try:
-                        await collection.delete_many({"_id": {"$in": keys_to_delete}})
-                    except Exception as e:
-                        print(f"Error deleting documents from {current_node_key}: {e}")
-
-                # Update last_id for pagination
-                last_id = documents[-1]["_id"]
-
-                print(f"Migrated batch up to _id: {last_id}")
+    # Only the arcs taken over by the new node's vnodes need to be read from the existing nodes
+    queries = {}
+    if isinstance(hash_ring, HashRing):
+        # Arc queries match on ring_hash, so documents stored before it was kept would stay behind
+        await backfill_ring_hash()
+        for low, high, old_node, new_node in changed_arcs(ring_snapshot(previous_ring), ring_snapshot()):
+            queries.setdefault(old_node, {"$or": []})["$or"].append(ring_hash_range(low, high))
+    else:
+        # Other engines don't move contiguous hash arcs, so scan every node for keys it no longer owns
+        queries = {node: {} for node in mongo_clients if node != new_node_key}
 
+    try:
+        for current_node_key, query in queries.items():
+            print(f"Migrating {len(query.get('$or', [])) or 'all'} hash ranges from {current_node_key} "
+                  f"to {new_node_key}")
+            migrated_count = await migrate_documents(label, current_node_key, mongo_clients[current_node_key], query,
+                                                     sort_field="ring_hash" if query else "_id", throttle=throttle)
             print(f"Finished migrating {migrated_count} documents from {current_node_key} to {new_node_key}")
-
-        except Exception as e:
-            print(f"Error during migration from {current_node_key} to {new_node_key}: {e}")
-
-
+            retag_cached_documents(current_node_key)
+    except Exception as e:
+        # Reads keep falling back to the previous owners until a rerun finishes the migration
+        print(f"Error during migration to {new_node_key}: {e}")
+        raise
+    await mongo_clients[new_node_key]['mydatabase']['migration_checkpoints'].delete_one({"_id": label})
+    end_rebalance()
 
 
 async def debug_key_assignments():
-    for key in range(0, 100):  # Use a smaller range for debugging
-        node = hash_ring.get_node(str(key))
-        print(f"Key: {key} -> Node: {node}")
+    keys = [str(key) for key in range(0, 100)]  # Use a smaller range for debugging
+    nodes = ring_nodes()
+    for key, node_index in zip(keys, route_many(keys)):
+        print(f"Key: {key} -> Node: {nodes[node_index]}")
 
 
 # Function to analyze key distribution over a larger range
-async def analyze_key_distribution(num_docs):
-    key_counts = {node: 0 for node in mongo_clients}
-
-    for i in range(num_docs):
-        key = str(i)
-        node = hash_ring.get_node(key)
-        key_counts[node] += 1
+async def analyze_key_distribution(num_docs, processes=1):
+    """Summarize where keys 0..num_docs-1 land, splitting the key space across worker processes and merging."""
+    if processes > 1:
+        span = -(-num_docs // (4 * processes))
+        loop = asyncio.get_running_loop()
+        with ProcessPoolExecutor(processes) as executor:
+            parts = await asyncio.gather(*(
+                loop.run_in_executor(executor, summarize_key_range, start, min(start + span, num_docs),
+                                     list(hash_ring.get_nodes()), placement_engine)
+                for start in range(0, num_docs, span)
+            ))
+        distribution = KeyDistribution()
+        for part in parts:
+            distribution.merge(part)
+    else:
+        distribution = summarize_key_range(0, num_docs)
 
     # Print key distribution summary
     print("\nKey Distribution Summary:")
-    for node, count in key_counts.items():
-        print(f"Node: {node} -> Total Keys: {count}")
+    distribution.report()
+    return distribution
+
+
+# Function to summarize the placement of keys start..end-1; worker processes pass the ring they should use
+def summarize_key_range(start, end, node_keys=None, engine=None):
+    if node_keys is not None:
+        use_placement(node_keys, engine)
+
+    distribution = KeyDistribution()
+    for chunk_start in range(start, end, routing_chunk_size):
+        chunk_end = min(chunk_start + routing_chunk_size, end)
+        keys = [str(i) for i in range(chunk_start, chunk_end)]
+        summarize_chunk(distribution, hash_many(keys), route_many(keys), np.arange(chunk_start, chunk_end))
+    return distribution
 
 
 async def data_distribution():
@@ -293,6 +1413,8 @@ async def main():
 
     # clean any previous data
     await delete_all_documents()
+    await ensure_ring_hash_index()
+    await backfill_ring_hash()
 
     num_documents = 100000  # Adjust as needed
     # Insert documents into MongoDB asynchronously
@@ -304,11 +1426,11 @@ async def main():
     time.sleep(2)
     # Find a document by key (simulate retrieval)
     example_key = "2000"  # Replace with an actual key
-    await find_document(example_key)
+    print(f"Key: {example_key} -> {await find_document(example_key) or 'not found'}")
     example_key = "3000"  # Replace with an actual key
-    await find_document(example_key)
+    print(f"Key: {example_key} -> {await find_document(example_key) or 'not found'}")
     example_key = "99999"  # Replace with an actual key
-    await find_document(example_key)
+    print(f"Key: {example_key} -> {await find_document(example_key) or 'not found'}")
 
     time.sleep(2)
     # Remove the node on port 27020 and migrate its data
@@ -321,11 +1443,11 @@ async def main():
     # Find a document by key (simulate retrieval)
     time.sleep(2)
     example_key = "2000"  # Replace with an actual key
-    await find_document(example_key)
+    print(f"Key: {example_key} -> {await find_document(example_key) or 'not found'}")
     example_key = "3000"  # Replace with an actual key
-    await find_document(example_key)
+    print(f"Key: {example_key} -> {await find_document(example_key) or 'not found'}")
     example_key = "99999"  # Replace with an actual key
-    await find_document(example_key)
+    print(f"Key: {example_key} -> {await find_document(example_key) or 'not found'}")
 
     await add_node_and_migrate_data("localhost", 27020)
     time.sleep(2)
@@ -334,13 +1456,18 @@ async def main():
 
 
     example_key = "2000"  # Replace with an actual key
-    await find_document(example_key)
+    print(f"Key: {example_key} -> {await find_document(example_key) or 'not found'}")
     example_key = "3000"  # Replace with an actual key
-    await find_document(example_key)
+    print(f"Key: {example_key} -> {await find_document(example_key) or 'not found'}")
     example_key = "99999"  # Replace with an actual key
-    await find_document(example_key)
-
-
+    print(f"Key: {example_key} -> {await find_document(example_key) or 'not found'}")
+
+    # Find several documents in one round trip per node
+    example_keys = ["2000", "3000", "99999", "not-a-key"]
+    for key, document in zip(example_keys, await find_documents(example_keys)):
+        print(f"Key: {key} -> {document if document else 'not found'}")
+    print(f"Document cache: {document_cache.stats()}")
+    metrics.report()
 
     # Delete all documents (clean up)
     await delete_all_documents()
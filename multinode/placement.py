@@ -0,0 +1,175 @@
+from hashlib import md5
+import numpy as np
+from uhashring import HashRing
+
+mask64 = (1 << 64) - 1
+
+
+# Function to hash a key to 64 bits: the high half of the md5 digest, the same bits hash_many puts in column 0
+def key_hash(key):
+    return int.from_bytes(md5(str(key).encode("utf-8")).digest()[:8], "big")
+
+
+# Function to scramble a 64-bit value (splitmix64 finalizer); works on ints and on numpy uint64 arrays
+def mix64(value):
+    if isinstance(value, np.ndarray):
+        value = (value ^ (value >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+        value = (value ^ (value >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+        return value ^ (value >> np.uint64(31))
+    value = ((value ^ (value >> 30)) * 0xbf58476d1ce4e5b9) & mask64
+    value = ((value ^ (value >> 27)) * 0x94d049bb133111eb) & mask64
+    return value ^ (value >> 31)
+
+
+# Common surface of the placement engines, matching the parts of uhashring.HashRing the scripts use
+class Placement:
+    def __init__(self, nodes=None):
+        self.nodes = list(nodes or [])
+        self.rebuild()
+
+    def rebuild(self):
+        pass
+
+    def get_nodes(self):
+        return list(self.nodes)
+
+    def add_node(self, node):
+        if node not in self.nodes:
+            self.nodes.append(node)
+            self.rebuild()
+
+    def remove_node(self, node):
+        if node in self.nodes:
+            self.nodes.remove(node)
+            self.rebuild()
+
+    def get_node(self, key):
+        if not self.nodes:
+            return None
+        return self.nodes[self.locate(key_hash(key))]
+
+    def preference_list(self, key, n=2):
+        """Return up to n distinct nodes for a key; the first one is the owner."""
+        if not self.nodes:
+            return ()
+        return tuple(self.nodes[index] for index in self.candidates(key_hash(key), min(n, len(self.nodes))))
+
+    # Function to route an array of 64-bit key hashes to indices into get_nodes()
+    def route_hashes(self, hashes):
+        if not self.nodes:
+            raise ValueError("The placement has no nodes")
+        return np.fromiter((self.locate(int(h)) for h in hashes), dtype=np.intp, count=len(hashes))
+
+
+# Jump consistent hash (Lamping & Veach): no per-node state, but only the last node can leave without reshuffling
+class JumpPlacement(Placement):
+    def locate(self, h):
+        bucket, candidate = -1, 0
+        while candidate < len(self.nodes):
+            bucket = candidate
+            h = (h * 2862933555777941757 + 1) & mask64
+            candidate = int((bucket + 1) * ((1 << 31) / ((h >> 33) + 1)))
+        return bucket
+
+    def candidates(self, h, n):
+        owner = self.locate(h)
+        return [(owner + offset) % len(self.nodes) for offset in range(n)]
+
+    def route_hashes(self, hashes):
+        if not self.nodes:
+            raise ValueError("The placement has no nodes")
+        keys = np.array(hashes, dtype=np.uint64)
+        buckets = np.full(len(keys), -1, dtype=np.int64)
+        candidates = np.zeros(len(keys), dtype=np.int64)
+        active = np.nonzero(candidates < len(self.nodes))[0]
+        while len(active):
+            buckets[active] = candidates[active]
+            keys[active] = keys[active] * np.uint64(2862933555777941757) + np.uint64(1)
+            scale = float(1 << 31) / ((keys[active] >> np.uint64(33)).astype(np.float64) + 1)
+            candidates[active] = ((buckets[active] + 1) * scale).astype(np.int64)
+            active = active[candidates[active] < len(self.nodes)]
+        return buckets.astype(np.intp)
+
+
+# Rendezvous (highest random weight) hashing: every node scores every key and the highest score wins
+class RendezvousPlacement(Placement):
+    def rebuild(self):
+        self.seeds = [key_hash(node) for node in self.nodes]
+        self.seed_array = np.array(self.seeds, dtype=np.uint64)
+
+    def locate(self, h):
+        scores = [mix64(h ^ seed) for seed in self.seeds]
+        return scores.index(max(scores))
+
+    def candidates(self, h, n):
+        return sorted(range(len(self.nodes)), key=lambda index: mix64(h ^ self.seeds[index]), reverse=True)[:n]
+
+    def route_hashes(self, hashes):
+        if not self.nodes:
+            raise ValueError("The placement has no nodes")
+        scores = mix64(np.asarray(hashes, dtype=np.uint64)[:, None] ^ self.seed_array[None, :])
+        return np.argmax(scores, axis=1).astype(np.intp)
+
+
+# Maglev hashing: a prime-sized lookup table filled round-robin from per-node permutations
+class MaglevPlacement(Placement):
+    def __init__(self, nodes=None, table_size=65537):
+        self.table_size = table_size
+        super().__init__(nodes)
+
+    def rebuild(self):
+        size = self.table_size
+        if not self.nodes:
+            self.table = np.zeros(0, dtype=np.intp)
+            return
+        permutations = []
+        for node in self.nodes:
+            digest = md5(str(node).encode("utf-8")).digest()
+            offset = int.from_bytes(digest[:8], "big") % size
+            skip = int.from_bytes(digest[8:], "big") % (size - 1) + 1
+            permutations.append((offset, skip))
+
+        table = [-1] * size
+        next_choice = [0] * len(self.nodes)
+        filled = 0
+        while filled < size:
+            for index, (offset, skip) in enumerate(permutations):
+                slot = (offset + next_choice[index] * skip) % size
+                while table[slot] >= 0:
+                    next_choice[index] += 1
+                    slot = (offset + next_choice[index] * skip) % size
+                table[slot] = index
+                next_choice[index] += 1
+                filled += 1
+                if filled == size:
+                    break
+        self.table = np.array(table, dtype=np.intp)
+
+    def locate(self, h):
+        return int(self.table[h % self.table_size])
+
+    def candidates(self, h, n):
+        # Walk the table from the key's slot; later distinct entries act as replicas
+        indices = []
+        slot = h % self.table_size
+        for offset in range(self.table_size):
+            index = int(self.table[(slot + offset) % self.table_size])
+            if index not in indices:
+                indices.append(index)
+                if len(indices) == n:
+                    break
+        return indices
+
+    def route_hashes(self, hashes):
+        if not self.nodes:
+            raise ValueError("The placement has no nodes")
+        return self.table[np.asarray(hashes, dtype=np.uint64) % np.uint64(self.table_size)]
+
+
+# Available engines by name; "ketama" is uhashring's vnode ring and the default
+placement_engines = {
+    "ketama": HashRing,
+    "jump": JumpPlacement,
+    "rendezvous": RendezvousPlacement,
+    "maglev": MaglevPlacement,
+}
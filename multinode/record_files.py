@@ -0,0 +1,73 @@
+import csv
+import json
+import mmap
+import os
+
+# File extensions bulk loads recognise; anything else needs an explicit format
+file_formats = {".jsonl": "jsonl", ".ndjson": "jsonl", ".json": "jsonl", ".csv": "csv"}
+
+
+# Function to pick the record format of a file from its extension
+def detect_format(path):
+    file_format = file_formats.get(os.path.splitext(path)[1].lower())
+    if file_format is None:
+        raise ValueError(f"Can't tell the format of {path}; pass jsonl or csv")
+    return file_format
+
+
+# Function to read lines of a mapped file starting at its current position
+def mapped_lines(buffer):
+    while True:
+        line = buffer.readline()
+        if not line:
+            return
+        yield line.decode("utf-8")
+
+
+# Generator over the records of a JSONL or CSV file from a byte offset, yielding (offset after the record, record)
+def read_records(path, file_format, offset=0):
+    if os.path.getsize(path) == 0:
+        return  # Empty files can't be mapped
+    with open(path, "rb") as record_file, \
+            mmap.mmap(record_file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        if hasattr(mmap, "MADV_SEQUENTIAL"):
+            buffer.madvise(mmap.MADV_SEQUENTIAL)  # Let the kernel read ahead and drop pages behind us
+
+        if file_format == "jsonl":
+            buffer.seek(offset)
+            for line in iter(buffer.readline, b""):
+                if line.strip():
+                    yield buffer.tell(), json.loads(line)
+            return
+
+        # The header always comes from the start of the file, whatever offset a resumed load starts at
+        header = next(csv.reader([buffer.readline().decode("utf-8-sig")]), None)
+        if header is None:
+            return
+        if offset > buffer.tell():
+            buffer.seek(offset)
+        # The reader pulls one line at a time, so the mapped position is the end of the row it just returned,
+        # quoted fields spanning lines included
+        for row in csv.reader(mapped_lines(buffer)):
+            if row:
+                yield buffer.tell(), dict(zip(header, row))
+
+
+# Function to read the byte offset and row count a bulk load last committed; (0, 0) when starting fresh
+def read_load_checkpoint(path):
+    try:
+        with open(path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+    except FileNotFoundError:
+        return 0, 0
+    return checkpoint["offset"], checkpoint["rows"]
+
+
+# Function to commit a bulk load's progress, replacing the old checkpoint in one rename
+def save_load_checkpoint(path, offset, rows):
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w") as checkpoint_file:
+        json.dump({"offset": offset, "rows": rows}, checkpoint_file)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+    os.replace(temporary_path, path)
@@ -0,0 +1,111 @@
+import json
+import mmap
+import os
+import struct
+from collections import Counter
+import numpy as np
+from uhashring import HashRing
+from placement import placement_engines
+
+# Snapshot file layout, little-endian:
+#   header  magic, format version, epoch, vnode count, node table length
+#   nodes   JSON {"engine": ..., "nodes": [{"name", "vnodes", "weight"}, ...]}, padded to 8 bytes
+#   arrays  high and low 64 bits of every vnode position (uint64, sorted), then the owner of each vnode (uint32)
+header_format = "<4sIQQQ"
+header_size = struct.calcsize(header_format)
+snapshot_magic = b"RING"
+snapshot_version = 1
+
+
+# Function to read only the epoch of a snapshot file; None if there is no snapshot yet
+def read_epoch(path):
+    try:
+        with open(path, "rb") as snapshot_file:
+            header = snapshot_file.read(header_size)
+    except FileNotFoundError:
+        return None
+    if len(header) < header_size:
+        return None
+    magic, version, epoch, _, _ = struct.unpack(header_format, header)
+    if magic != snapshot_magic or version != snapshot_version:
+        raise ValueError(f"{path} is not a version {snapshot_version} ring snapshot")
+    return epoch
+
+
+# Ring membership and vnode positions at one epoch, stored as flat arrays that load through a memory map
+class RingSnapshot:
+    def __init__(self, epoch, engine, nodes, high=None, low=None, owners=None):
+        self.epoch = epoch
+        self.engine = engine
+        self.nodes = nodes  # [{"name", "vnodes", "weight"}] in owner index order
+        self.high = high if high is not None else np.zeros(0, dtype=np.uint64)
+        self.low = low if low is not None else np.zeros(0, dtype=np.uint64)
+        self.owners = owners if owners is not None else np.zeros(0, dtype=np.uint32)
+        self.buffer = None
+
+    # Function to capture a placement engine; only the ketama ring has vnode arrays, the others rebuild from their nodes
+    @classmethod
+    def capture(cls, ring, engine, epoch):
+        if not isinstance(ring, HashRing):
+            return cls(epoch, engine, [{"name": node} for node in ring.get_nodes()])
+        names = list(ring.get_nodes())
+        node_index = {node: index for index, node in enumerate(names)}
+        nodes = [{"name": node, "vnodes": ring.conf[node]["vnodes"], "weight": ring.conf[node]["weight"]}
+                 for node in names]
+        ring_keys = ring._keys
+        high = np.array([hash_key >> 64 for hash_key in ring_keys], dtype=np.uint64)
+        low = np.array([hash_key & 0xFFFFFFFFFFFFFFFF for hash_key in ring_keys], dtype=np.uint64)
+        owners = np.array([node_index[ring.ring[hash_key]] for hash_key in ring_keys], dtype=np.uint32)
+        return cls(epoch, engine, nodes, high, low, owners)
+
+    # Write to a temporary file and rename it over the old snapshot, so readers never see a partial one
+    def save(self, path):
+        table = json.dumps({"engine": self.engine, "nodes": self.nodes}).encode("utf-8")
+        table += b" " * (-len(table) % 8)
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, "wb") as snapshot_file:
+            snapshot_file.write(struct.pack(header_format, snapshot_magic, snapshot_version, self.epoch,
+                                            len(self.high), len(table)))
+            snapshot_file.write(table)
+            snapshot_file.write(self.high.astype("<u8").tobytes())
+            snapshot_file.write(self.low.astype("<u8").tobytes())
+            snapshot_file.write(self.owners.astype("<u4").tobytes())
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temporary_path, path)
+
+    # Function to map a snapshot file; the arrays are views into the mapping, so loading copies no vnode data.
+    # The batch router uses these views directly; placement() still builds per-vnode Python objects from them
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as snapshot_file:
+            buffer = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, epoch, vnode_count, table_length = struct.unpack_from(header_format, buffer)
+        if magic != snapshot_magic or version != snapshot_version:
+            raise ValueError(f"{path} is not a version {snapshot_version} ring snapshot")
+        table = json.loads(bytes(buffer[header_size:header_size + table_length]))
+        offset = header_size + table_length
+        high = np.frombuffer(buffer, dtype="<u8", count=vnode_count, offset=offset)
+        low = np.frombuffer(buffer, dtype="<u8", count=vnode_count, offset=offset + 8 * vnode_count)
+        owners = np.frombuffer(buffer, dtype="<u4", count=vnode_count, offset=offset + 16 * vnode_count)
+        snapshot = cls(epoch, table["engine"], table["nodes"], high, low, owners)
+        snapshot.buffer = buffer
+        return snapshot
+
+    def node_names(self):
+        return [node["name"] for node in self.nodes]
+
+    # Function to get a placement engine routing exactly like the captured one, without rehashing any vnodes.
+    # uhashring's single-key lookups need its own sorted key list and dict, so this costs one pass over the vnodes
+    def placement(self):
+        if self.engine != "ketama":
+            return placement_engines[self.engine](nodes=self.node_names())
+        ring = HashRing(nodes=[])
+        ring._configure_nodes({node["name"]: {"vnodes": node["vnodes"], "weight": node["weight"]}
+                               for node in self.nodes})
+        names = self.node_names()
+        ring_keys = [(high << 64) | low for high, low in zip(self.high.tolist(), self.low.tolist())]
+        ring.runtime._keys = ring_keys
+        ring.runtime._ring = dict(zip(ring_keys, [names[owner] for owner in self.owners.tolist()]))
+        ring.runtime._distribution = Counter({node["name"]: node["vnodes"] * node["weight"] for node in self.nodes})
+        return ring
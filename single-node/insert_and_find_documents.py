@@ -3,18 +3,24 @@ import uuid
 import time
 from motor.motor_asyncio import AsyncIOMotorClient
 
+
+# Function to connect to the storage node; swap it for another backend returning a Motor-compatible client
+def create_client(uri):
+    return AsyncIOMotorClient(uri)
+
+
 # Initialize MongoDB client with authentication
 mongo_uri = "mongodb://localhost:27018/"
-client = AsyncIOMotorClient(mongo_uri)
+client = create_client(mongo_uri)
 db = client['mydatabase']
 collection = db['mycollection']
 
 
 # Function to insert documents into MongoDB using async/await
-async def insert_documents(num_docs, batch_size=100000):
+async def insert_documents(num_docs, batch_size=100000, max_in_flight=4):
     start_time = time.time()
     documents = []
-    tasks = []
+    tasks = set()
 
 
     # Count total documents
@@ -29,11 +35,16 @@ async def insert_documents(num_docs, batch_size=100000):
         documents.append(document)
 
         if len(documents) == batch_size:
-            tasks.append(insert_documents_in_batch(documents))
+            # Only max_in_flight batches exist at a time, instead of the whole dataset waiting on one gather
+            if len(tasks) >= max_in_flight:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()
+            tasks.add(asyncio.create_task(insert_documents_in_batch(documents)))
             documents = []
 
     if documents:
-        tasks.append(insert_documents_in_batch(documents))
+        tasks.add(asyncio.create_task(insert_documents_in_batch(documents)))
 
     await asyncio.gather(*tasks)
 